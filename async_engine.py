@@ -0,0 +1,300 @@
+'''
+asyncio variant of the game engine.
+
+Drives many matches concurrently from one process: every pokerbot connection
+is a stream pair on the event loop, and each query is bounded by the
+player's remaining game clock with asyncio.wait_for.
+'''
+import argparse
+import asyncio
+from pathlib import Path
+import socket
+import subprocess
+import time
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from config import *
+from engine import BuildCache, LogWriter, Match, MatchRecord, Player, TRANSPORTS, message, STATUS
+from tournament import discover_bots, prebuild, schedule, write_results
+
+class AsyncPlayer(Player):
+    '''
+    Handles subprocess and stream interactions with one player's pokerbot
+    on the event loop.
+    '''
+
+    def __init__(self, name, path, output_dir, *, capture, protocol='json', transport='tcp', log_compression='none'):
+        super().__init__(name, path, output_dir, capture=capture, protocol=protocol, transport=transport, log_compression=log_compression)
+        self.reader = None
+        self.writer = None
+        self.output_task = None
+
+    async def build(self, cache=None):
+        '''
+        Loads the commands file and builds the pokerbot, or replays its
+        cached build output.
+        '''
+        self.load_commands()
+        if self.commands is not None and len(self.commands['build']) > 0:
+            if cache is not None:
+                output = cache.lookup(self.path)
+                if output is not None:
+                    print(self.name, 'build is up to date')
+                    self.output.write(output)
+                    return
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *self.commands['build'],
+                    **({
+                        'stdout': subprocess.PIPE,
+                        'stderr': subprocess.STDOUT,
+                    } if self.capture else {}),
+                    cwd=self.path,
+                )
+                try:
+                    outs, _ = await asyncio.wait_for(proc.communicate(), BUILD_TIMEOUT)
+                    self.output.write(outs)
+                    if cache is not None and proc.returncode == 0:
+                        cache.store(self.path, outs)
+                except asyncio.TimeoutError:
+                    error_message = 'Timed out waiting for ' + self.name + ' to build'
+                    print(error_message)
+                    proc.kill()
+                    await proc.wait()
+                    self.output.write(error_message.encode())
+            except (TypeError, ValueError):
+                print(self.name, 'build command misformatted')
+            except OSError:
+                print(self.name, 'build failed - check "build" in commands.json')
+
+    async def pump_output(self, out):
+        while chunk := await out.read(65536):
+            self.output.write(chunk)
+
+    async def run(self):
+        '''
+        Runs the pokerbot and waits for it to connect.
+        '''
+        if self.commands is not None and len(self.commands['run']) > 0:
+            connected = asyncio.get_running_loop().create_future()
+
+            def on_connect(reader, writer):
+                if connected.done():
+                    writer.close()
+                else:
+                    connected.set_result((reader, writer))
+
+            try:
+                with TRANSPORTS[self.transport]() as transport:
+                    server = None
+                    if transport.server_socket is not None:
+                        transport.server_socket.setblocking(False)
+                        start_server = asyncio.start_unix_server if transport.family == socket.AF_UNIX else asyncio.start_server
+                        server = await start_server(on_connect, sock=transport.server_socket)
+                    proc = await asyncio.create_subprocess_exec(
+                        *self.commands['run'], *transport.args,
+                        **({
+                            'stdout': subprocess.PIPE,
+                            'stderr': subprocess.STDOUT
+                        } if self.capture else {}),
+                        cwd=self.path,
+                        pass_fds=transport.pass_fds,
+                    )
+                    self.bot_subprocess = proc
+                    if self.capture:
+                        self.output_task = asyncio.create_task(self.pump_output(proc.stdout))
+                    if server is None:
+                        on_connect(*await asyncio.open_connection(sock=transport.accept()))
+                    try:
+                        self.reader, self.writer = await asyncio.wait_for(connected, CONNECT_TIMEOUT)
+                    finally:
+                        if server is not None:
+                            server.close()
+                    self.append(self.hello())
+                    print(self.name, 'connected successfully')
+            except asyncio.TimeoutError:
+                print('Timed out waiting for', self.name, 'to connect')
+            except (TypeError, ValueError):
+                print(self.name, 'run command misformatted')
+            except OSError:
+                print(self.name, 'run failed - check "run" in commands.json')
+
+    async def stop(self, as_player):
+        '''
+        Closes the connection and stops the pokerbot.
+        '''
+        # one that ran out of time may be hung, so it only gets a moment to quit
+        timeout = CONNECT_TIMEOUT if self.game_clock > 0. else HUNG_BOT_TIMEOUT
+        if self.writer is not None:
+            try:
+                self.append(message('goodbye'))
+                await self.query(None, None, wait=False)
+                self.writer.close()
+                await asyncio.wait_for(self.writer.wait_closed(), timeout)
+            except asyncio.TimeoutError:
+                print('Timed out waiting for', self.name, 'to disconnect')
+            except OSError:
+                print('Could not close socket connection with', self.name)
+        if self.bot_subprocess is not None:
+            try:
+                await asyncio.wait_for(self.bot_subprocess.wait(), timeout)
+            except asyncio.TimeoutError:
+                print('Timed out waiting for', self.name, 'to quit')
+                self.bot_subprocess.kill()
+                await self.bot_subprocess.wait()
+        if self.output_task is not None:
+            await self.output_task
+        self.output.close()
+
+    async def query(self, record, game_log, *, wait=True):
+        legal_actions = record.legal_actions() if isinstance(record, MatchRecord) else set()
+        if self.writer is not None and (self.game_clock > 0. or not wait):
+            clause = ''
+            try:
+                packet = self.packet()
+                if not wait:
+                    deadline = CONNECT_TIMEOUT if self.game_clock > 0. else HUNG_BOT_TIMEOUT
+                elif ENFORCE_GAME_CLOCK:
+                    deadline = self.game_clock
+                else:
+                    deadline = CONNECT_TIMEOUT
+                start_time = time.perf_counter()
+                self.writer.write(packet)
+                await asyncio.wait_for(self.writer.drain(), deadline)
+                if not wait:
+                    return None
+                if self.protocol == 'compact':
+                    response = (await asyncio.wait_for(self.reader.read(1), deadline)).decode()
+                else:
+                    response = (await asyncio.wait_for(self.reader.readline(), deadline)).decode().strip()
+                end_time = time.perf_counter()
+                self.response_log.append(response)
+                self.charge(end_time - start_time)
+                action = self.parse_response(response)
+                action = self.resolve(action, legal_actions, game_log)
+                if action is not None:
+                    return action
+            except (socket.timeout, asyncio.TimeoutError):
+                error_message = self.name + ' ran out of time'
+                if game_log is not None:
+                    game_log.append(error_message)
+                print(error_message)
+                self.game_clock = 0.
+            except OSError:
+                error_message = self.name + ' disconnected'
+                if game_log is not None:
+                    game_log.append(error_message)
+                print(error_message)
+                self.game_clock = 0.
+            except (IndexError, KeyError, TypeError, ValueError):
+                game_log.append(f'Response from {self.name} misformatted: ' + str(clause))
+        return None
+
+class AsyncMatch(Match):
+    '''
+    Manages logging and the high-level game procedure on the event loop.
+    '''
+
+    async def run_round(self, players):
+        self.send_round_state(players)
+        # each seat logs separately so the gamelog stays in seat order
+        game_logs = [[], []]
+        actions = await asyncio.gather(*[
+            player.query(self.record, game_log)
+            for player, game_log in zip(players, game_logs)
+        ])
+        self.play_actions(players, actions, game_logs)
+
+    async def run(self):
+        '''
+        Runs one matchup. Returns the (name, score) pair of each player, in p1, p2 order.
+        '''
+        players = self.create_players(AsyncPlayer, protocol=self.protocol, transport=self.transport)
+        self.record = MatchRecord(self.n_rounds)
+        cache = BuildCache(self.build_cache) if self.build_cache is not None else None
+
+        async def start(player):
+            await player.build(cache)
+            await player.run()
+
+        if Path(players[0].path).resolve() == Path(players[1].path).resolve():
+            # one directory must not be built twice at once; the second build is cached
+            for player in players:
+                await start(player)
+        else:
+            await asyncio.gather(*[start(player) for player in players])
+        for round_num in range(1, self.n_rounds + 1):
+            self.log.append('')
+            self.log.append('Round #' + str(round_num) + STATUS(players))
+            await self.run_round(players)
+            if self.switch_seats:
+                players = players[::-1]
+        self.log.append('')
+        self.log.append('Final' + STATUS(players))
+        for i, player in enumerate(players):
+            await player.stop(i)
+        return await asyncio.to_thread(self.write_logs, players)
+
+async def run_matches(matches, concurrency):
+    '''
+    Runs matches on the event loop, at most concurrency at a time.
+    Returns their scores in order.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_match(match):
+        async with semaphore:
+            return await match.run()
+
+    return await asyncio.gather(*[run_match(match) for match in matches])
+
+async def run_tournament(bots, *, output_path, n_rounds, concurrency, **options):
+    '''
+    Runs every pairing of bots from this process and writes the combined
+    result file. Returns the list of per-match scores.
+    '''
+    build_cache = options.setdefault('build_cache', BUILD_CACHE_PATH)
+    if build_cache is not None:
+        await asyncio.to_thread(prebuild, bots, BuildCache(build_cache), capture=options.get('capture', True))
+    matches = [
+        AsyncMatch(p1=p1, p2=p2, output_path=output_path, n_rounds=n_rounds, **options)
+        for p1, p2 in schedule(bots)
+    ]
+    results = await run_matches(matches, concurrency)
+    write_results(output_path, results)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Round-robin tournament over every discovered bot, multiplexed on one event loop")
+    parser.add_argument('paths', nargs='*', default=TOURNAMENT_PATHS, metavar='PATH', help='Bot directories, or directories containing bots')
+    parser.add_argument("-o", "--output", default=LOGS_PATH, metavar='PATH', help="Output directory for game results")
+    parser.add_argument("-n", "--n-rounds", default=1000, metavar='INT', help="Number of rounds to run per matchup")
+    parser.add_argument("-c", "--concurrency", type=int, default=100, metavar='INT', help='Maximum number of matches to run at once')
+    parser.add_argument("--switch-seats", default=False, action=argparse.BooleanOptionalAction, help='Do players switch seats between rounds')
+    parser.add_argument("--capture", default=False, action=argparse.BooleanOptionalAction, help='Capture player outputs and write them to log files')
+    parser.add_argument("--protocol", default=PROTOCOL, choices=['json', 'compact'], help='Wire protocol to offer players at hello')
+    parser.add_argument("--transport", default=TRANSPORT, choices=sorted(TRANSPORTS), help='How players connect to the engine')
+    parser.add_argument("--seed", type=int, default=SEED, metavar='INT', help='Seed of the random actions played for bots that fail to act')
+    parser.add_argument("--build-cache", default=BUILD_CACHE_PATH, metavar='PATH', help='Build every bot once up front and skip builds of unchanged bots')
+    parser.add_argument("--no-build-cache", dest='build_cache', action='store_const', const=None, help='Build both bots before every match')
+    parser.add_argument("--log-compression", default=LOG_COMPRESSION, choices=sorted(LogWriter.OPENERS), help='Compress game logs and message transcripts as they are written')
+
+    args = parser.parse_args()
+
+    bots = discover_bots(args.paths)
+    print(f'Found {len(bots)} bots: ' + ', '.join(name for name, _ in bots))
+    asyncio.run(run_tournament(
+        bots,
+        output_path = args.output,
+        n_rounds = args.n_rounds,
+        concurrency = args.concurrency,
+        switch_seats = args.switch_seats,
+        capture = args.capture,
+        protocol = args.protocol,
+        transport = args.transport,
+        log_compression = args.log_compression,
+        build_cache = args.build_cache,
+        seed = args.seed,
+    ))
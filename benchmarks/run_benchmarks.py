@@ -0,0 +1,175 @@
+'''
+Engine throughput benchmarks.
+
+Runs engine Matches between the deterministic reference bots over a grid of
+match lengths, capture settings, transports and wire protocols. The
+in-process transport imports the bots into the engine, so the wire protocol
+does not apply to it. Every configuration runs in a fresh subprocess so its
+peak RSS and CPU time are its own. Results are written as JSON and compared
+against a stored baseline; a run without a baseline fails unless it saves
+one.
+'''
+import argparse
+from itertools import combinations, product
+from pathlib import Path
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+BOTS = ['scissors', 'repetitive', 'copycat']
+ROUNDS = [1000, 10000]
+TRANSPORTS = ['tcp', 'unix', 'socketpair', 'in-process']
+PROTOCOLS = ['json', 'compact']
+BASELINE_PATH = ROOT / 'benchmarks' / 'baseline.json'
+RESULTS_PATH = ROOT / 'benchmarks' / 'results.json'
+
+def configurations(rounds, captures, transports, protocols):
+    '''
+    Builds the benchmark grid: every pair of reference bots at every match
+    length, capture setting, transport and protocol.
+    '''
+    return [
+        {
+            'name': f"{p1}.{p2}.n{n_rounds}.{'capture' if capture else 'nocapture'}.{transport}"
+                    + ('' if transport == 'in-process' else f'.{protocol}'),
+            'p1': p1,
+            'p2': p2,
+            'n_rounds': n_rounds,
+            'capture': capture,
+            'transport': transport,
+            'protocol': protocol,
+        }
+        for (p1, p2), n_rounds, capture, transport, protocol in product(combinations(BOTS, 2), rounds, captures, transports, protocols)
+        # in-process bots get their messages directly, in any protocol
+        if transport != 'in-process' or protocol == protocols[0]
+    ]
+
+def measure(config):
+    '''
+    Runs one configuration in this process. Returns its measurements.
+    '''
+    import resource
+    from engine import Match
+    in_process = config['transport'] == 'in-process'
+    with tempfile.TemporaryDirectory(prefix='rps-bench-') as output_path:
+        match = Match(
+            p1 = (config['p1'], str(ROOT / 'players' / config['p1'])),
+            p2 = (config['p2'], str(ROOT / 'players' / config['p2'])),
+            output_path = output_path,
+            n_rounds = config['n_rounds'],
+            capture = config['capture'],
+            in_process = in_process,
+            transport = 'tcp' if in_process else config['transport'],
+            protocol = config['protocol'],
+        )
+        start_time = time.perf_counter()
+        match.run()
+        wall = time.perf_counter() - start_time
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'wall': wall,
+        'rounds_per_second': config['n_rounds'] / wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'max_rss_kb': usage.ru_maxrss,
+    }
+
+def run_configuration(config, repeat):
+    '''
+    Runs a configuration repeat times, each in a fresh subprocess, and keeps
+    the fastest run. Returns None if every run failed.
+    '''
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, __file__, '--measure', json.dumps(config)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=ROOT,
+            check=False,
+        )
+        lines = proc.stdout.decode(errors='replace').strip().splitlines()
+        if proc.returncode != 0 or not lines:
+            print(f"WARN {config['name']} failed:", *lines[-5:], sep='\n')
+            continue
+        result = json.loads(lines[-1])
+        if best is None or result['wall'] < best['wall']:
+            best = result
+    return best
+
+def compare(results, baseline, tolerance):
+    '''
+    Compares results against a baseline. Returns the names of
+    configurations whose throughput dropped or whose engine CPU time or peak
+    RSS grew by more than tolerance.
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        changes = {
+            'rounds/s': result['rounds_per_second'] / base['rounds_per_second'] - 1,
+            'cpu': result['cpu'] / base['cpu'] - 1,
+            'rss': result['max_rss_kb'] / base['max_rss_kb'] - 1,
+        }
+        regressed = (changes['rounds/s'] < -tolerance
+                     or changes['cpu'] > tolerance
+                     or changes['rss'] > tolerance)
+        print(f"{'REGRESSED' if regressed else 'ok':>9} {name}: "
+              + ', '.join(f'{key} {change:+.1%}' for key, change in changes.items()))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Engine throughput benchmarks against the reference bots")
+    parser.add_argument("-n", "--n-rounds", type=int, nargs='+', default=ROUNDS, metavar='INT', help='Match lengths to benchmark')
+    parser.add_argument("--transport", nargs='+', default=TRANSPORTS, choices=TRANSPORTS, help='Transports to benchmark')
+    parser.add_argument("--protocol", nargs='+', default=PROTOCOLS, choices=PROTOCOLS, help='Wire protocols to benchmark')
+    parser.add_argument("--capture", nargs='+', default=['off', 'on'], choices=['on', 'off'], help='Capture settings to benchmark')
+    parser.add_argument("-r", "--repeat", type=int, default=1, metavar='INT', help='Runs per configuration, the fastest is kept')
+    parser.add_argument("-o", "--output", default=RESULTS_PATH, metavar='PATH', help='Where to write the results')
+    parser.add_argument("--baseline", default=BASELINE_PATH, metavar='PATH', help='Results to compare against')
+    parser.add_argument("--save-baseline", default=False, action=argparse.BooleanOptionalAction, help='Also store the results as the new baseline')
+    parser.add_argument("--tolerance", type=float, default=0.15, metavar='FLOAT', help='Relative change that counts as a regression')
+    parser.add_argument("--measure", metavar='JSON', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(json.loads(args.measure))))
+        sys.exit()
+
+    results = {}
+    for config in configurations(args.n_rounds, [capture == 'on' for capture in args.capture], args.transport, args.protocol):
+        result = run_configuration(config, args.repeat)
+        if result is None:
+            continue
+        results[config['name']] = {**config, **result}
+        print(f"{config['name']}: {result['rounds_per_second']:.0f} rounds/s, "
+              f"{result['cpu']:.2f}s cpu, {result['max_rss_kb'] / 1024:.1f} MiB")
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(args.output, 'w') as results_file:
+        json.dump(report, results_file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+    elif Path(args.baseline).is_file():
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    else:
+        print(f'No baseline at {args.baseline} to compare against, record one on this machine with --save-baseline')
+        sys.exit(2)
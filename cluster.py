@@ -0,0 +1,324 @@
+'''
+Multi-node tournament runner for the RPS game engine.
+
+A coordinator holds the round-robin schedule and hands matches out to
+worker agents, which run them as engine Matches and send back the scores
+and round records. Results are collected and written centrally by the
+coordinator. Bot paths are sent as the coordinator found them, so every
+worker must see the bots at the same paths, e.g. from the same checkout.
+
+Workers connect to the coordinator over TCP and exchange json lines:
+hello -> worker : STRING name of the worker (worker to coordinator)
+job -> id : INT, p1, p2 : [name, path] of each seat, options : DICT of
+  Match options (coordinator to worker)
+result -> id : INT, scores : LIST of [name, score], rounds : STRING base64
+  of the rounds file (worker to coordinator)
+failed -> id : INT, error : STRING (worker to coordinator)
+done -> [no fields], no jobs are left (coordinator to worker)
+
+A job whose worker fails it, disconnects or takes longer than JOB_TIMEOUT
+is queued again, at most JOB_ATTEMPTS times in all. Pairings whose scores
+are in the results cache are not handed out at all.
+'''
+import argparse
+import base64
+from collections import deque
+from multiprocessing import Process
+from pathlib import Path
+from threading import Condition, Thread
+import json
+import os
+import socket
+import sys
+import traceback
+
+sys.path.append(os.getcwd())
+from config import *
+from engine import LogWriter, Match, TRANSPORTS, hash_bot
+from results_db import ResultsDB
+from tournament import ResultsCache, discover_bots, pairing_keys, pairing_scores, schedule, write_results, write_scores
+
+def send(socketfile, msg):
+    socketfile.write((json.dumps(msg) + '\n').encode())
+    socketfile.flush()
+
+def receive(socketfile):
+    '''
+    Reads the next message, or returns None if the connection closed.
+    '''
+    line = socketfile.readline()
+    return json.loads(line) if line else None
+
+class Coordinator():
+    '''
+    Hands out the matches of a tournament to workers and collects their
+    results.
+    '''
+
+    def __init__(self, bots, *, output_path, options, results_cache=RESULTS_CACHE_PATH, db=None):
+        self.output_path = output_path
+        self.options = options
+        self.db = ResultsDB(db) if db is not None else None
+        self.pairings = schedule(bots)
+        self.attempts = [0] * len(self.pairings)
+        self.results = {}
+        self.failed = set()
+        self.in_flight = 0
+        self.condition = Condition()
+        self.cache = None
+        if results_cache is not None:
+            self.cache = ResultsCache(results_cache)
+            self.keys = pairing_keys(
+                self.pairings,
+                seed = options['seed'],
+                n_rounds = options['n_rounds'],
+                switch_seats = options['switch_seats'],
+            )
+            Path(output_path).mkdir(parents=True, exist_ok=True)
+            for job, key in enumerate(self.keys):
+                scores = self.cache.lookup(key)
+                if scores is not None:
+                    self.results[job] = pairing_scores(self.pairings[job], scores)
+                    write_scores(output_path, self.pairings[job], self.results[job])
+            print(f'{len(self.results)} of {len(self.pairings)} pairings are cached')
+        self.queue = deque(job for job in range(len(self.pairings)) if job not in self.results)
+
+    def next_job(self):
+        '''
+        Takes the next job off the queue. While jobs are out that may still
+        be queued again, waits for one of them. Returns None once every job
+        is finished.
+        '''
+        with self.condition:
+            while not self.queue and self.in_flight:
+                self.condition.wait()
+            if not self.queue:
+                return None
+            self.in_flight += 1
+            return self.queue.popleft()
+
+    def complete(self, job, reply):
+        '''
+        Writes the result of a job centrally.
+        '''
+        (p1_name, _), (p2_name, _) = self.pairings[job]
+        # ordered by the pairing, as the match directory is named from it
+        scores = pairing_scores(self.pairings[job], reply['scores'])
+        match_dir = Path(self.output_path, f'{p1_name}.{p2_name}')
+        match_dir.mkdir(parents=True, exist_ok=True)
+        rounds = base64.b64decode(reply['rounds'])
+        (match_dir / f'{ROUNDS_FILENAME}.bin').write_bytes(rounds)
+        write_scores(self.output_path, self.pairings[job], scores)
+        if self.db is not None:
+            # recorded here rather than on the workers, so results stay in one place
+            (p1_name, p1_path), (p2_name, p2_path) = self.pairings[job]
+            self.db.record_match(
+                p1 = (p1_name, hash_bot(p1_path)),
+                p2 = (p2_name, hash_bot(p2_path)),
+                scores = scores,
+                rounds = rounds,
+                seed = self.options['seed'],
+                n_rounds = int(self.options['n_rounds']),
+                switch_seats = self.options['switch_seats'],
+                engine_version = ENGINE_VERSION,
+            )
+        if self.cache is not None:
+            self.cache.store(self.keys[job], scores)
+        with self.condition:
+            self.results[job] = scores
+            self.in_flight -= 1
+            n_finished = len(self.results) + len(self.failed)
+            self.condition.notify_all()
+        print(f'[{n_finished}/{len(self.pairings)}] ' + ' vs '.join(f'{name} ({score:+.2f})' for name, score in scores))
+
+    def retry(self, job, reason):
+        '''
+        Queues a job again, unless it has used up its attempts.
+        '''
+        (p1_name, _), (p2_name, _) = self.pairings[job]
+        with self.condition:
+            self.in_flight -= 1
+            self.attempts[job] += 1
+            if self.attempts[job] < JOB_ATTEMPTS:
+                print(f'WARN {p1_name} vs {p2_name} {reason}, retrying')
+                self.queue.append(job)
+            else:
+                print(f'WARN {p1_name} vs {p2_name} {reason}, giving up after {JOB_ATTEMPTS} attempts')
+                self.failed.add(job)
+            self.condition.notify_all()
+
+    def serve_worker(self, connection):
+        '''
+        Feeds jobs to one worker until none are left or the worker is lost.
+        '''
+        with connection, connection.makefile('rwb') as socketfile:
+            try:
+                connection.settimeout(CONNECT_TIMEOUT)
+                hello = receive(socketfile)
+                worker = hello['worker']
+            except (OSError, ValueError, TypeError, KeyError):
+                return
+            print(f'Worker {worker} connected')
+            while (job := self.next_job()) is not None:
+                (p1, p2) = self.pairings[job]
+                try:
+                    send(socketfile, {'type': 'job', 'id': job, 'p1': p1, 'p2': p2, 'options': self.options})
+                    connection.settimeout(JOB_TIMEOUT)
+                    reply = receive(socketfile)
+                except socket.timeout:
+                    self.retry(job, f'timed out on {worker}')
+                    return
+                except (OSError, ValueError):
+                    reply = None
+                if reply is None:
+                    self.retry(job, f'was lost with {worker}')
+                    return
+                if not isinstance(reply, dict):
+                    self.retry(job, f'got a malformed reply from {worker}')
+                elif reply.get('type') == 'result' and reply.get('id') == job:
+                    try:
+                        self.complete(job, reply)
+                    except (KeyError, TypeError, ValueError):
+                        self.retry(job, f'got a malformed result from {worker}')
+                    except Exception as e:
+                        # the job must not stay in flight, or next_job waits for it forever
+                        traceback.print_exc()
+                        self.retry(job, f'could not be recorded from {worker} ({e!r})')
+                else:
+                    self.retry(job, f"failed on {worker}: {reply.get('error')}")
+            try:
+                send(socketfile, {'type': 'done'})
+            except OSError:
+                pass
+            print(f'Worker {worker} finished')
+
+    def run(self, host, port):
+        '''
+        Serves workers until every job is finished, then writes the combined
+        result file. Returns the list of per-match scores.
+        '''
+        Path(self.output_path).mkdir(parents=True, exist_ok=True)
+        with socket.create_server((host, port)) as server_socket:
+            server_socket.settimeout(1.)
+            print(f'Coordinating {len(self.queue)} matches on {host}:{port}')
+            while len(self.results) + len(self.failed) < len(self.pairings):
+                try:
+                    connection, _ = server_socket.accept()
+                except socket.timeout:
+                    continue
+                Thread(target=self.serve_worker, args=(connection,), daemon=True).start()
+        results = [self.results[job] for job in sorted(self.results)]
+        write_results(self.output_path, results)
+        return results
+
+def run_job(job, output_path):
+    '''
+    Runs one job. Returns the reply to send back to the coordinator.
+    '''
+    try:
+        match = Match(
+            p1 = job['p1'],
+            p2 = job['p2'],
+            output_path = output_path,
+            # the rounds file is read back straight away
+            **{**job['options'], 'background': False},
+        )
+        scores = match.run()
+        rounds = Path(match.match_dir, f'{ROUNDS_FILENAME}.bin').read_bytes()
+        return {
+            'type': 'result',
+            'id': job['id'],
+            'scores': scores,
+            'rounds': base64.b64encode(rounds).decode(),
+        }
+    except Exception as e:
+        traceback.print_exc()
+        return {'type': 'failed', 'id': job['id'], 'error': repr(e)}
+
+def work(address, name, output_path):
+    '''
+    Runs the jobs the coordinator hands out until it says it is done. A
+    worker whose connection is lost, e.g. after the coordinator gave up on
+    a job that took too long, connects again for its next job. It stops
+    once the coordinator can no longer be reached.
+    '''
+    host, port = address
+    while True:
+        try:
+            connection = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        except OSError:
+            return
+        with connection, connection.makefile('rwb') as socketfile:
+            try:
+                connection.settimeout(None)
+                send(socketfile, {'type': 'hello', 'worker': name})
+                while (job := receive(socketfile)) is not None and job['type'] == 'job':
+                    send(socketfile, run_job(job, output_path))
+                if job is not None:
+                    return
+            except (OSError, ValueError) as e:
+                print(f'WARN {name} lost the coordinator ({e!r}), reconnecting')
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Round-robin tournament spread over worker agents")
+    subparsers = parser.add_subparsers(dest='role', required=True)
+
+    coordinator_parser = subparsers.add_parser('coordinator', help='Hand out the matches and collect the results')
+    coordinator_parser.add_argument('paths', nargs='*', default=TOURNAMENT_PATHS, metavar='PATH', help='Bot directories, or directories containing bots')
+    coordinator_parser.add_argument("--listen", default=f'0.0.0.0:{CLUSTER_PORT}', metavar='HOST:PORT', help='Address to accept workers on')
+    coordinator_parser.add_argument("-o", "--output", default=LOGS_PATH, metavar='PATH', help="Output directory for the collected results")
+    coordinator_parser.add_argument("-n", "--n-rounds", type=int, default=1000, metavar='INT', help="Number of rounds to run per matchup")
+    coordinator_parser.add_argument("--switch-seats", default=False, action=argparse.BooleanOptionalAction, help='Do players switch seats between rounds')
+    coordinator_parser.add_argument("--capture", default=False, action=argparse.BooleanOptionalAction, help='Capture player outputs and write them to log files on the workers')
+    coordinator_parser.add_argument("--protocol", default=PROTOCOL, choices=['json', 'compact'], help='Wire protocol to offer players at hello')
+    coordinator_parser.add_argument("--transport", default=TRANSPORT, choices=sorted(TRANSPORTS), help='How players connect to the engine')
+    coordinator_parser.add_argument("--log-compression", default=LOG_COMPRESSION, choices=sorted(LogWriter.OPENERS), help='Compress game logs and message transcripts as they are written')
+    coordinator_parser.add_argument("--seed", type=int, default=SEED, metavar='INT', help='Seed of the random actions played for bots that fail to act')
+    coordinator_parser.add_argument("--results-cache", default=RESULTS_CACHE_PATH, metavar='PATH', help='Only hand out pairings whose scores are not cached for the current bots and settings')
+    coordinator_parser.add_argument("--no-results-cache", dest='results_cache', action='store_const', const=None, help='Hand out every pairing')
+    coordinator_parser.add_argument("--db", metavar='PATH', help='Also write every match result to this SQLite results database')
+    coordinator_parser.add_argument("--zygote", default=False, action=argparse.BooleanOptionalAction, help='Fork python3 player.py bots from a pre-warmed interpreter on each worker')
+    coordinator_parser.add_argument("--reuse-bots", default=False, action=argparse.BooleanOptionalAction, help='Keep bots that support new_match running between matches on each worker')
+
+    worker_parser = subparsers.add_parser('worker', help='Run matches handed out by a coordinator')
+    worker_parser.add_argument('coordinator', metavar='HOST:PORT', help='Address of the coordinator')
+    worker_parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), metavar='INT', help='Number of matches to run in parallel, defaults to the core count')
+    worker_parser.add_argument("-o", "--output", default=LOGS_PATH, metavar='PATH', help="Output directory for the local game logs")
+    worker_parser.add_argument("--name", default=socket.gethostname(), help='Name of this worker in the coordinator log')
+
+    args = parser.parse_args()
+
+    if args.role == 'coordinator':
+        bots = discover_bots(args.paths)
+        print(f'Found {len(bots)} bots: ' + ', '.join(name for name, _ in bots))
+        Coordinator(
+            bots,
+            output_path = args.output,
+            results_cache = args.results_cache,
+            db = args.db,
+            options = {
+                'n_rounds': args.n_rounds,
+                'switch_seats': args.switch_seats,
+                'capture': args.capture,
+                'protocol': args.protocol,
+                'transport': args.transport,
+                'log_compression': args.log_compression,
+                'seed': args.seed,
+                'zygote': args.zygote,
+                'reuse_bots': args.reuse_bots,
+            },
+        ).run(*parse_address(args.listen))
+    else:
+        # each agent process runs one match at a time over its own connection
+        agents = [
+            Process(target=work, args=(parse_address(args.coordinator), f'{args.name}/{i}', args.output))
+            for i in range(args.workers)
+        ]
+        for agent in agents:
+            agent.start()
+        for agent in agents:
+            agent.join()
@@ -7,6 +7,10 @@ PLAYER_2_PATH = './players/live'
 # GAME PROGRESS IS RECORDED HERE
 GAME_LOG_FILENAME = 'gamelog'
 SCORE_FILENAME = 'scores'
+ROUNDS_FILENAME = 'rounds'
+LATENCY_FILENAME = 'latency'
+PROFILE_FILENAME = 'profile'
+TOURNAMENT_FILENAME = 'tournament'
 LOGS_PATH = 'logs'
 # PLAYER_LOG_SIZE_LIMIT IS IN BYTES
 PLAYER_LOG_SIZE_LIMIT = 524288
@@ -15,3 +19,33 @@ ENFORCE_GAME_CLOCK = True
 STARTING_GAME_CLOCK = 30.
 BUILD_TIMEOUT = 10.
 CONNECT_TIMEOUT = 10.
+# A POKERBOT THAT RAN OUT OF TIME IS KILLED IF IT HAS NOT QUIT BY THEN
+HUNG_BOT_TIMEOUT = 0.1
+# BUILD OUTPUTS ARE CACHED HERE, KEYED BY A HASH OF THE BOT DIRECTORY
+BUILD_CACHE_PATH = '.build_cache'
+# TOURNAMENT MATCH SCORES ARE CACHED HERE, KEYED BY BOTH BOT HASHES, THE SEED,
+# THE MATCH SETTINGS AND ENGINE_VERSION. BUMP ENGINE_VERSION WHENEVER AN
+# ENGINE CHANGE CAN CHANGE THE OUTCOME OF A MATCH
+RESULTS_CACHE_PATH = '.results_cache'
+ENGINE_VERSION = 1
+# AT MOST BOT_POOL_SIZE IDLE POKERBOTS ARE KEPT RUNNING BETWEEN MATCHES
+BOT_POOL_SIZE = 16
+# MULTI-MATCH RUNNERS FINISH UP TO BACKGROUND_WORKERS MATCHES AT ONCE IN THE BACKGROUND
+BACKGROUND_WORKERS = 4
+# LOGS ARE WRITTEN OUT IN CHUNKS OF LOG_BUFFER_SIZE CHARACTERS,
+# COMPRESSED WITH LOG_COMPRESSION: 'none', 'gzip' OR 'lzma'
+LOG_BUFFER_SIZE = 65536
+LOG_COMPRESSION = 'none'
+# WIRE PROTOCOL OFFERED TO PLAYERS AT HELLO: 'json' OR 'compact'
+PROTOCOL = 'json'
+# HOW PLAYERS CONNECT TO THE ENGINE: 'tcp', 'unix' OR 'socketpair'
+TRANSPORT = 'tcp'
+# BOTS ARE DISCOVERED UNDER THESE DIRECTORIES BY THE TOURNAMENT RUNNER
+TOURNAMENT_PATHS = ['./players', './submit']
+# EVERY MATCH DRAWS ITS FALLBACK ACTIONS FROM ITS OWN GENERATOR, SEEDED FROM SEED AND THE MATCHUP
+SEED = 68127
+# CLUSTER WORKERS CONNECT TO THE COORDINATOR ON CLUSTER_PORT. A JOB THAT TAKES
+# LONGER THAN JOB_TIMEOUT SECONDS IS RETRIED, AT MOST JOB_ATTEMPTS TIMES IN ALL
+CLUSTER_PORT = 7171
+JOB_TIMEOUT = 120.
+JOB_ATTEMPTS = 3
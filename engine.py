@@ -5,9 +5,14 @@ Poker Camp Game Engine - version 2024/09/08 for RPS Hackathon @ Fractal
 Derived from: 6.176 MIT Pokerbots Game Engine at mitpokerbots/engine
 '''
 import argparse
-from collections import namedtuple
-from threading import Thread
-from queue import Queue
+import cProfile
+from collections import namedtuple, deque
+from array import array
+from itertools import count
+from threading import Thread, Lock, local
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+from multiprocessing.util import Finalize
 import time
 import json
 from pathlib import Path
@@ -17,15 +22,25 @@ import socket
 import sys
 import os
 import hashlib
+import struct
+import tempfile
+import shutil
+import gzip
+import lzma
+import math
+import queue
+import traceback
+import importlib
+import importlib.util
 
 sys.path.append(os.getcwd())
 from config import *
+from records import RecordWriter
+from results_db import ResultsDB
+from zygote import Zygote
 
 import random
 
-random.seed(68127)
-
-STARTING_STACK = 0
 ANTE = 1
 
 class RockAction(namedtuple('RockAction', [])):
@@ -52,8 +67,6 @@ class ScissorsAction(namedtuple('ScissorsAction', [])):
     def __repr__(self):
         return 'Scissors'
 
-TerminalState = namedtuple('TerminalState', ['deltas', 'previous_state'])
-
 DECODE = {'R': RockAction, 'P': PaperAction, 'S': ScissorsAction}
 PVALUE = lambda name, value: f', {name} ({value:+d})'
 STATUS = lambda players: ''.join([PVALUE(p.name, p.bankroll) for p in players])
@@ -63,11 +76,12 @@ STATUS = lambda players: ''.join([PVALUE(p.name, p.bankroll) for p in players])
 #
 # A MESSAGE is a json object with a 'type' field (STRING). Depending on
 #   the type, zero or more other fields may be required:
-# hello -> [no fields]
+# hello -> protocols : optional LIST of STRING framings you may switch to
 # time -> time : FLOAT match timer remaining
 # info -> info : INFO_DICT information available to you
 # action -> action : ACTION_DICT, player : INT
 # payoff -> payoff : FLOAT incremental payoff to you
+# new_match -> [no fields]
 # goodbye -> [no fields]
 #
 # An INFO_DICT may include game-dependent fields; most games will have:
@@ -88,191 +102,707 @@ STATUS = lambda players: ''.join([PVALUE(p.name, p.bankroll) for p in players])
 # The actions report both players' actions (including yours) in order.
 #
 # A player takes an action by sending a legal action message. This is
-#  currently the only legal message for players to send.
+#  currently the only legal message for players to send, apart from the
+#  hello reply below.
+#
+# A player may answer hello with {'type': 'hello', 'features': ['new_match']}
+#  to say it can play several matches on one connection. Instead of goodbye,
+#  the last packet of a match may then end with a new_match message, which
+#  needs no reply: the player resets its bot and the next packet starts a
+#  new match.
+#
+# An engine may open a connection with a packet holding nothing but a hello
+#  that offers features = ['multiplex'], which the player answers with its
+#  hello alone. If that hello lists 'multiplex' too, every later packet may
+#  belong to one of several concurrent matches: each of its messages
+#  carries that match's id as 'match', and so must the reply. A goodbye with
+#  a match id only ends that match. The player must answer packets in the
+#  order they arrive: a match's clock is charged from when its packet was
+#  sent or the previous reply arrived, whichever is later, so time spent on
+#  the other matches is not counted against it.
+#
+# If the engine's hello offers protocols = ['compact'], a player may accept
+#  by sending {'type': 'hello', 'protocol': 'compact'} alongside its first
+#  action. Every later packet is then a run of fixed-size COMPACT_FRAMEs
+#  instead of a json line:
+# tag : CHAR A (act), U (results only), N (new match) or G (goodbye)
+# time : FLOAT32 match timer remaining
+# my verb, their verb : CHAR verbs of the last round, '-' if none
+# payoff : INT8 incremental payoff to you
+# The player answers every A frame with a single verb byte.
+
+COMPACT_FRAME = struct.Struct('<cfccb')
+NO_VERB = b'-'
 
 def message(type, **kwargs):
     result = {'type': type}
     result.update(kwargs)
     return result
 
-class RoundState(namedtuple('_RoundState', ['turn_number', 'street', 'pips', 'stacks', 'hands', 'deck', 'action_history', 'previous_state'])):
-    @staticmethod
-    def new():
-        hands = [None, None]
-        pips = [ANTE, ANTE]
-        stacks = [STARTING_STACK - ANTE, STARTING_STACK - ANTE]
-        return RoundState(
-            turn_number=0,
-            street=0,
-            pips=pips,
-            stacks=stacks,
-            hands=hands,
-            deck=None,
-            action_history=[],
-            previous_state=None,
-        )
-    
-    def showdown(self):
-        hands = self.hands
-        pips = self.pips
-        
-        beats = [
-            (RockAction(), ScissorsAction()),
-            (ScissorsAction(), PaperAction()),
-            (PaperAction(), RockAction()),
-        ]
-        if (self.action_history[0], self.action_history[1]) in beats:
-            winner = 0
-            loser = 1
-        elif (self.action_history[1], self.action_history[0]) in beats:
-            winner = 1
-            loser = 0
+class LogWriter():
+    '''
+    Line-oriented log file that is written out whenever its buffer fills,
+    optionally compressed on the fly, so it never holds a whole match.
+    '''
+    OPENERS = {'none': open, 'gzip': gzip.open, 'lzma': lzma.open}
+    SUFFIXES = {'none': '', 'gzip': '.gz', 'lzma': '.xz'}
+
+    def __init__(self, path, *, compression='none', buffer_size=LOG_BUFFER_SIZE):
+        self.file = self.OPENERS[compression](path + self.SUFFIXES[compression], 'wt')
+        self.buffer_size = buffer_size
+        self.lines = []
+        self.size = 0
+        self.separator = ''
+
+    def append(self, line):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            # lines are newline-separated, with no newline at the end of the file
+            self.file.write(self.separator + '\n'.join(self.lines))
+            self.separator = '\n'
+            self.lines = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class OutputCapture():
+    '''
+    Bounded capture of a pokerbot's output. The first half of the size limit
+    is written straight to the log file; past that only a rolling tail
+    window is kept, and it is appended when the capture is closed.
+    '''
+
+    def __init__(self, path, limit):
+        self.limit = limit
+        self.lock = Lock()
+        self.file = None
+        self.reopen(path, 'wb')
+
+    def reopen(self, path, mode='ab'):
+        '''
+        Starts capturing into another log file, for a pokerbot that keeps
+        running into its next match. Output written while the capture is
+        closed is dropped.
+        '''
+        with self.lock:
+            self.file = open(path, mode)
+            self.head_room = self.limit // 2
+            self.tail_limit = self.limit - self.head_room
+            self.tail = deque()
+            self.tail_size = 0
+            self.dropped = 0
+
+    def write(self, data):
+        if not data:
+            return
+        with self.lock:
+            if self.file.closed:
+                return
+            if self.head_room > 0:
+                head = data[:self.head_room]
+                self.file.write(head)
+                self.head_room -= len(head)
+                data = data[len(head):]
+                if not data:
+                    return
+            self.tail.append(data)
+            self.tail_size += len(data)
+            while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+                chunk = self.tail.popleft()
+                self.tail_size -= len(chunk)
+                self.dropped += len(chunk)
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            excess = self.tail_size - self.tail_limit
+            if excess > 0:
+                self.tail[0] = self.tail[0][excess:]
+                self.dropped += excess
+            if self.dropped:
+                self.file.write(f'\n... [{self.dropped} bytes omitted] ...\n'.encode())
+            for chunk in self.tail:
+                self.file.write(chunk)
+            self.tail.clear()
+            self.file.close()
+
+class LatencyHistogram():
+    '''
+    Streaming histogram of a pokerbot's response times, in log-spaced
+    buckets of BUCKETS_PER_DECADE per factor of ten above MIN_LATENCY.
+    '''
+    MIN_LATENCY = 1e-6
+    BUCKETS_PER_DECADE = 20
+    N_BUCKETS = 9 * BUCKETS_PER_DECADE
+
+    def __init__(self):
+        self.counts = [0] * self.N_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, latency):
+        if latency > self.MIN_LATENCY:
+            bucket = min(int(math.log10(latency / self.MIN_LATENCY) * self.BUCKETS_PER_DECADE), self.N_BUCKETS - 1)
         else:
-            winner = None
-            loser = None
-        
-        deltas = [0, 0]
-        if winner is not None:
-            deltas[winner] = pips[loser]
-            deltas[loser] = -pips[loser]
-        
-        return TerminalState(deltas, self)
-    
-    def public(self):
-        return {}
+            bucket = 0
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def upper_bound(self, bucket):
+        return self.MIN_LATENCY * 10 ** ((bucket + 1) / self.BUCKETS_PER_DECADE)
+
+    def percentile(self, p):
+        '''
+        Returns an upper bound on the p-th percentile latency, accurate to
+        one bucket, or None if nothing was recorded.
+        '''
+        if self.count == 0:
+            return None
+        rank = math.ceil(p / 100 * self.count)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'total': self.total,
+            'buckets': {f'{self.upper_bound(bucket):.3g}': count for bucket, count in enumerate(self.counts) if count},
+        }
+
+class PhaseProfiler():
+    '''
+    Splits the engine's wall time into phases by timing instrumented
+    methods. A call is charged only for time not spent in instrumented
+    calls nested inside it, and each thread keeps its own totals.
+    '''
+    PHASES = ('message building', 'encoding', 'socket write', 'waiting for bot', 'parsing', 'logging', 'state transitions')
+
+    def __init__(self):
+        self.local = local()
+        self.thread_totals = []
+        self.lock = Lock()
+
+    def state(self):
+        try:
+            return self.local.totals, self.local.stack
+        except AttributeError:
+            self.local.totals = dict.fromkeys(self.PHASES, 0.)
+            self.local.stack = []
+            with self.lock:
+                self.thread_totals.append(self.local.totals)
+            return self.local.totals, self.local.stack
+
+    def timed(self, phase, function):
+        '''
+        Wraps function so its calls are charged to phase.
+        '''
+        def wrapper(*args, **kwargs):
+            totals, stack = self.state()
+            stack.append(0.)  # time spent in nested instrumented calls
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start_time
+                totals[phase] += elapsed - stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+        return wrapper
+
+    def instrument(self, target, phase, *names):
+        for name in names:
+            setattr(target, name, self.timed(phase, getattr(target, name)))
+
+    def instrument_match(self, match, players):
+        '''
+        Instruments a match's game procedure, writers and players.
+        '''
+        self.instrument(match, 'message building', 'send_round_state', 'send_action', 'send_terminal_state')
+        self.instrument(match.record, 'state transitions', 'showdown')
+        self.instrument(match.log, 'logging', 'append', 'flush')
+        self.instrument(match.round_records, 'logging', 'append', 'flush')
+        for player in players:
+            self.instrument(player, 'message building', 'packet')
+            self.instrument(player, 'encoding', 'encode_packet')
+            self.instrument(player, 'parsing', 'parse_response')
+            self.instrument(player, 'state transitions', 'charge', 'resolve')
+            self.instrument(player.message_log, 'logging', 'append', 'flush')
+            self.instrument(player.response_log, 'logging', 'append', 'flush')
+            if player.local_bot is not None:
+                self.instrument(player.local_bot, 'waiting for bot', 'query')
+            if player.socketfile is not None:
+                player.socketfile = ProfiledFile(player.socketfile, self)
+
+    def summary(self, elapsed, n_rounds):
+        '''
+        Sums the phase totals over threads. Time not charged to any phase is
+        reported as other; with concurrent queries the phases of both seats
+        overlap, so they may add up to more than the wall time.
+        '''
+        phases = dict.fromkeys(self.PHASES, 0.)
+        with self.lock:
+            for totals in self.thread_totals:
+                for phase, total in totals.items():
+                    phases[phase] += total
+        phases['other'] = max(elapsed - sum(phases.values()), 0.)
+        return {
+            'rounds': n_rounds,
+            'wall': elapsed,
+            'rounds_per_second': n_rounds / elapsed if elapsed > 0. else None,
+            'phases': phases,
+        }
+
+    @staticmethod
+    def report(summary):
+        lines = [f"{summary['rounds']} rounds in {summary['wall']:.3f}s ({summary['rounds_per_second'] or 0.:.0f} rounds/s)"]
+        for phase, total in summary['phases'].items():
+            lines.append(f"{phase:>18} {total:9.3f}s {100 * total / summary['wall']:6.1f}% {1e6 * total / max(summary['rounds'], 1):9.1f}us/round")
+        return '\n'.join(lines)
+
+class ProfiledFile():
+    '''
+    Socket file whose writes and reads are charged to a PhaseProfiler.
+    '''
+
+    def __init__(self, file, profiler):
+        self.file = file
+        self.write = profiler.timed('socket write', file.write)
+        self.flush = profiler.timed('socket write', file.flush)
+        self.read = profiler.timed('waiting for bot', file.read)
+        self.readline = profiler.timed('waiting for bot', file.readline)
+
+    def close(self):
+        self.file.close()
+
+class MatchRecord():
+    '''
+    Compact record of a match: both seats' actions and deltas for every round,
+    kept in byte arrays preallocated for the whole match.
+    '''
+    ACTIONS = (RockAction, PaperAction, ScissorsAction)
+    CODES = {RockAction: 0, PaperAction: 1, ScissorsAction: 2}
+    # seat 0's delta for each pair of action codes: each action beats the one before it
+    OUTCOMES = tuple((0, ANTE, -ANTE)[(a0 - a1) % 3] for a0 in range(3) for a1 in range(3))
+
+    def __init__(self, n_rounds):
+        self.n_rounds = n_rounds
+        self.rounds_played = 0
+        self.actions = [array('b', bytes(n_rounds)), array('b', bytes(n_rounds))]
+        self.deltas = [array('b', bytes(n_rounds)), array('b', bytes(n_rounds))]
 
     def legal_actions(self):
         return {RockAction, PaperAction, ScissorsAction}
 
-    def proceed(self, action):
-        state = RoundState(
-            turn_number = self.turn_number + 1,
-            street = self.street,
-            pips = self.pips,
-            stacks = self.stacks,
-            hands = self.hands,
-            deck = self.deck,
-            action_history = self.action_history + [action],
-            previous_state = self,
-        )
-        
-        if self.turn_number == 1:
-            return state.showdown()
+    def showdown(self, actions):
+        '''
+        Records the actions of both seats for the next round. Returns the
+        deltas of both seats.
+        '''
+        i = self.rounds_played
+        code0 = self.CODES[type(actions[0])]
+        code1 = self.CODES[type(actions[1])]
+        delta = self.OUTCOMES[3 * code0 + code1]
+        self.actions[0][i] = code0
+        self.actions[1][i] = code1
+        self.deltas[0][i] = delta
+        self.deltas[1][i] = -delta
+        self.rounds_played = i + 1
+        return (delta, -delta)
+
+class TcpTransport():
+    '''
+    Listens on an ephemeral TCP port for the pokerbot to connect to.
+    '''
+    family = socket.AF_INET
+
+    def __init__(self):
+        self.server_socket = socket.socket(self.family, socket.SOCK_STREAM)
+        self.server_socket.bind(('', 0))
+        self.server_socket.settimeout(CONNECT_TIMEOUT)
+        self.server_socket.listen()
+        self.args = [str(self.server_socket.getsockname()[1])]
+        self.pass_fds = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def accept(self):
+        '''
+        Blocks until we timeout or the pokerbot connects.
+        '''
+        client_socket, _ = self.server_socket.accept()
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client_socket
+
+    def close(self):
+        self.server_socket.close()
+
+class UnixTransport(TcpTransport):
+    '''
+    Listens on a Unix domain socket in a private temporary directory.
+    '''
+    family = socket.AF_UNIX
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix='rps-')
+        path = f'{self.directory}/engine.sock'
+        self.server_socket = socket.socket(self.family, socket.SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.settimeout(CONNECT_TIMEOUT)
+        self.server_socket.listen()
+        self.args = ['--unix', path]
+        self.pass_fds = ()
+
+    def accept(self):
+        '''
+        Blocks until we timeout or the pokerbot connects.
+        '''
+        client_socket, _ = self.server_socket.accept()
+        return client_socket
+
+    def close(self):
+        self.server_socket.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class SocketPairTransport(TcpTransport):
+    '''
+    Hands the pokerbot one end of a connected socketpair as an inherited fd.
+    '''
+    family = socket.AF_UNIX
+
+    def __init__(self):
+        self.server_socket = None
+        self.engine_socket, self.bot_socket = socket.socketpair()
+        self.args = ['--fd', str(self.bot_socket.fileno())]
+        self.pass_fds = (self.bot_socket.fileno(),)
+
+    def accept(self):
+        '''
+        Returns the engine end once the pokerbot has inherited its end.
+        '''
+        self.bot_socket.close()
+        return self.engine_socket
+
+    def close(self):
+        self.bot_socket.close()
+
+TRANSPORTS = {
+    'tcp': TcpTransport,
+    'unix': UnixTransport,
+    'socketpair': SocketPairTransport,
+}
+
+class InProcessBot():
+    '''
+    Hosts a trusted Python pokerbot inside the engine process.
+
+    The bot's Player class is imported from its directory together with its
+    own skeleton, and packets are handed to the skeleton Runner as message
+    lists instead of going through a subprocess and socket.
+    '''
+
+    def __init__(self, name, path):
+        path = os.path.abspath(path)
+        self.purge_skeleton()
+        sys.path.insert(0, path)
+        try:
+            spec = importlib.util.spec_from_file_location(f'player_{name}', f'{path}/player.py')
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            runner_module = importlib.import_module('skeleton.runner')
+        finally:
+            sys.path.remove(path)
+            # the next bot must import its own copy of the skeleton
+            self.purge_skeleton()
+        # every bot ships its own skeleton, and older copies cannot be driven in process
+        if not all(hasattr(runner_module.Runner, method) for method in ('handle', 'encode')):
+            raise ImportError(f'the skeleton of {name} is too old to be loaded in process')
+        self.runner = runner_module.Runner(module.Player(), None)
+
+    @staticmethod
+    def purge_skeleton():
+        for module_name in [m for m in sys.modules if m == 'skeleton' or m.startswith('skeleton.')]:
+            del sys.modules[module_name]
+
+    def query(self, messages):
+        '''
+        Delivers a packet to the bot and returns its action class, or None if
+        it did not act.
+        '''
+        action = self.runner.handle(messages)
+        if action is None:
+            return None
+        return DECODE[self.runner.encode(action)]
+
+def load_commands(name, path):
+    '''
+    Loads a pokerbot's commands file. Returns None if it is missing or
+    misformatted.
+    '''
+    try:
+        with open(path + '/commands.json', 'r') as json_file:
+            commands = json.load(json_file)
+        if ('build' in commands and 'run' in commands and
+                isinstance(commands['build'], list) and
+                isinstance(commands['run'], list)):
+            return commands
         else:
-            return state
-        
+            print(name, 'commands.json missing command')
+    except FileNotFoundError:
+        print(name, f'commands.json not found - check PLAYER_PATH={path}')
+    except json.decoder.JSONDecodeError:
+        print(name, 'commands.json misformatted')
+    return None
+
+def hash_bot(path):
+    '''
+    Hashes a pokerbot's directory tree: the relative path and contents of
+    every file, skipping Python bytecode.
+    '''
+    root = Path(path).resolve()
+    digest = hashlib.sha256()
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        for filename in sorted(filenames):
+            if filename.endswith('.pyc'):
+                continue
+            file_path = Path(directory, filename)
+            try:
+                file_hash = hashlib.sha256()
+                with open(file_path, 'rb') as bot_file:
+                    while chunk := bot_file.read(65536):
+                        file_hash.update(chunk)
+                file_digest = file_hash.digest()
+            except OSError:
+                continue
+            digest.update(str(file_path.relative_to(root)).encode() + b'\0' + file_digest)
+    return digest.hexdigest()
+
+class BuildCache():
+    '''
+    Outputs of successful pokerbot builds, keyed by the hash of the bot
+    directory as the build left it. A bot whose tree still hashes the same
+    does not need to be built again.
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def lookup(self, bot_path):
+        '''
+        Returns the cached build output of a bot, or None if it must be built.
+        '''
+        try:
+            return (self.path / f'{hash_bot(bot_path)}.out').read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def store(self, bot_path, output):
+        self.path.mkdir(parents=True, exist_ok=True)
+        # written aside and renamed, as parallel builds may share the cache
+        fd, temp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as cache_file:
+            cache_file.write(output or b'')
+        os.replace(temp_path, self.path / f'{hash_bot(bot_path)}.out')
+
+def build_bot(name, path, command, *, capture, cache=None):
+    '''
+    Runs a pokerbot's build command, unless the cache holds a build of its
+    current tree. Returns the build output.
+    '''
+    if cache is not None:
+        output = cache.lookup(path)
+        if output is not None:
+            print(name, 'build is up to date')
+            return output
+    try:
+        proc = subprocess.run(
+            command,
+            **({
+                'stdout': subprocess.PIPE,
+                'stderr': subprocess.STDOUT,
+            } if capture else {}),
+            cwd=path,
+            timeout=BUILD_TIMEOUT,
+            check=False,
+        )
+        if cache is not None and proc.returncode == 0:
+            cache.store(path, proc.stdout)
+        return proc.stdout
+    except subprocess.TimeoutExpired as timeout_expired:
+        error_message = 'Timed out waiting for ' + name + ' to build'
+        print(error_message)
+        return (timeout_expired.stdout or b'') + error_message.encode()
+    except (TypeError, ValueError):
+        print(name, 'build command misformatted')
+    except OSError:
+        print(name, 'build failed - check "build" in commands.json')
+    return None
+
 class Player():
     '''
     Handles subprocess and socket interactions with one player's pokerbot.
     '''
 
-    def __init__(self, name, path, output_dir, *, capture):
+    def __init__(self, name, path, output_dir, *, capture, in_process=False, protocol='json', transport='tcp', log_compression='none', zygote=None, pool=None, multiplexer=None):
         self.name = name
         self.path = path
         self.stdout_path = f'{output_dir}/{self.name}.stdout.txt'
         self.capture = capture
+        self.in_process = in_process
+        self.offered_protocol = protocol
+        self.transport = transport
+        self.zygote = zygote
+        self.pool = pool
+        self.multiplexer = multiplexer
+        self.match_id = None
+        self.protocol = 'json'
+        self.features = set()
+        self.reusable = False
+        self.seat = 0
         self.game_clock = STARTING_GAME_CLOCK
         self.bankroll = 0
+        self.latency = float('nan')
+        self.latencies = LatencyHistogram()
         self.commands = None
         self.bot_subprocess = None
         self.messages = [message('time', time=30.)]
+        self.connection = None
         self.socketfile = None
-        self.bytes_queue = Queue()
-        self.message_log = []
-        self.response_log = []
+        self.local_bot = None
+        self.output = OutputCapture(self.stdout_path, PLAYER_LOG_SIZE_LIMIT)
+        self.output_thread = None
+        self.message_log = LogWriter(f'{output_dir}/{self.name}.msg.server.txt', compression=log_compression)
+        self.response_log = LogWriter(f'{output_dir}/{self.name}.msg.player.txt', compression=log_compression)
 
-    def build(self):
+    def load_commands(self):
         '''
-        Loads the commands file and builds the pokerbot.
+        Loads the commands file.
         '''
-        try:
-            with open(self.path + '/commands.json', 'r') as json_file:
-                commands = json.load(json_file)
-            if ('build' in commands and 'run' in commands and
-                    isinstance(commands['build'], list) and
-                    isinstance(commands['run'], list)):
-                self.commands = commands
-            else:
-                print(self.name, 'commands.json missing command')
-        except FileNotFoundError:
-            print(self.name, f'commands.json not found - check PLAYER_PATH={self.path}')
-        except json.decoder.JSONDecodeError:
-            print(self.name, 'commands.json misformatted')
+        self.commands = load_commands(self.name, self.path)
+
+    def build(self, cache=None):
+        '''
+        Loads the commands file and builds the pokerbot, or replays its
+        cached build output.
+        '''
+        self.load_commands()
         if self.commands is not None and len(self.commands['build']) > 0:
-            try:
-                proc = subprocess.run(
-                    self.commands['build'],
-                    **({
-                        'stdout': subprocess.PIPE,
-                        'stderr': subprocess.STDOUT,
-                    } if self.capture else {}),
-                    cwd=self.path,
-                    timeout=BUILD_TIMEOUT,
-                    check=False,
-                )
-                self.bytes_queue.put(proc.stdout)
-            except subprocess.TimeoutExpired as timeout_expired:
-                error_message = 'Timed out waiting for ' + self.name + ' to build'
-                print(error_message)
-                self.bytes_queue.put(timeout_expired.stdout)
-                self.bytes_queue.put(error_message.encode())
-            except (TypeError, ValueError):
-                print(self.name, 'build command misformatted')
-            except OSError:
-                print(self.name, 'build failed - check "build" in commands.json')
+            self.output.write(build_bot(self.name, self.path, self.commands['build'], capture=self.capture, cache=cache))
 
     def run(self):
         '''
         Runs the pokerbot and establishes the socket connection.
         '''
+        if self.in_process:
+            if Path(self.path, 'player.py').is_file():
+                try:
+                    self.local_bot = InProcessBot(self.name, self.path)
+                    self.append(message('hello'))
+                    print(self.name, 'loaded in process')
+                    return
+                except Exception as e:
+                    print(self.name, f'could not be loaded in process ({e!r}), running it as a subprocess')
+            else:
+                print(self.name, 'has no player.py, running it as a subprocess')
+        if self.pool is not None and self.pool.acquire(self):
+            print(self.name, 'reused from an earlier match')
+            return
+        if self.multiplexer is not None:
+            channel = self.multiplexer.open(self)
+            if channel is not None:
+                self.connection = channel
+                self.socketfile = channel
+                self.match_id = channel.match_id
+                print(self.name, f'joined its shared process as match {self.match_id}')
+                return
         if self.commands is not None and len(self.commands['run']) > 0:
             try:
-                server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                with server_socket:
-                    server_socket.bind(('', 0))
-                    server_socket.settimeout(CONNECT_TIMEOUT)
-                    server_socket.listen()
-                    port = server_socket.getsockname()[1]
-                    proc = subprocess.Popen(
-                        self.commands['run'] + [str(port)],
-                        **({
-                            'stdout': subprocess.PIPE,
-                            'stderr': subprocess.STDOUT
-                        } if self.capture else {}),
-                        cwd=self.path,
-                    )
+                with TRANSPORTS[self.transport]() as transport:
+                    if self.zygote is not None and self.zygote.can_run(self.commands['run'], transport):
+                        proc = self.zygote.spawn(self.path, transport.args, capture=self.capture, timeout=CONNECT_TIMEOUT)
+                    else:
+                        proc = subprocess.Popen(
+                            self.commands['run'] + transport.args,
+                            **({
+                                'stdout': subprocess.PIPE,
+                                'stderr': subprocess.STDOUT
+                            } if self.capture else {}),
+                            cwd=self.path,
+                            pass_fds=transport.pass_fds,
+                        )
                     self.bot_subprocess = proc
                     
                     if self.capture:
-                        # function for bot listening
-                        def enqueue_output(out, queue):
-                            try:
-                                for line in out:
-                                    queue.put(line)
-                            except ValueError:
-                                pass
                         # start a separate bot listening thread which dies with the program
-                        Thread(target=enqueue_output, args=(proc.stdout, self.bytes_queue), daemon=True).start()
+                        self.output_thread = Thread(target=self.pump_output, args=(proc.stdout,), daemon=True)
+                        self.output_thread.start()
                     
-                    # block until we timeout or the player connects
-                    client_socket, _ = server_socket.accept()
+                    client_socket = transport.accept()
                     with client_socket:
                         client_socket.settimeout(CONNECT_TIMEOUT)
-                        sock = client_socket.makefile('rw')
+                        self.connection = client_socket
+                        sock = client_socket.makefile('rwb')
                         self.socketfile = sock
-                        self.append(message('hello'))
+                        self.append(self.hello())
                         print(self.name, 'connected successfully')
+            except socket.timeout:
+                print('Timed out waiting for', self.name, 'to connect')
             except (TypeError, ValueError):
                 print(self.name, 'run command misformatted')
             except OSError:
                 print(self.name, 'run failed - check "run" in commands.json')
-            except socket.timeout:
-                print('Timed out waiting for', self.name, 'to connect')
 
     def stop(self, as_player):
+        '''
+        Ends the match for the pokerbot. A pokerbot that can play another
+        match is handed to the pool, and one shared with other matches is
+        left running. Any other is shut down.
+        '''
+        if self.match_id is not None:
+            self.append(message('goodbye'))
+            self.query(None, None, wait=False)
+            self.socketfile.close()
+            self.output.close()
+            return
+        if self.pool is not None and self.reusable and self.socketfile is not None:
+            self.append(message('new_match'))
+            self.query(None, None, wait=False)
+            if self.game_clock > 0.:
+                self.output.close()
+                self.pool.release(self)
+                return
+        self.shutdown()
+
+    def shutdown(self):
         '''
         Closes the socket connection and stops the pokerbot.
         '''
+        if self.local_bot is not None:
+            self.append(message('goodbye'))
+            self.query(None, None, wait=False)
         if self.socketfile is not None:
             try:
                 self.append(message('goodbye'))
@@ -284,103 +814,558 @@ class Player():
                 print('Could not close socket connection with', self.name)
         if self.bot_subprocess is not None:
             try:
-                outs, _ = self.bot_subprocess.communicate(timeout=CONNECT_TIMEOUT)
-                self.bytes_queue.put(outs)
+                # one that ran out of time may be hung, so it only gets a moment to quit
+                self.bot_subprocess.wait(timeout=CONNECT_TIMEOUT if self.game_clock > 0. else HUNG_BOT_TIMEOUT)
             except subprocess.TimeoutExpired:
                 print('Timed out waiting for', self.name, 'to quit')
                 self.bot_subprocess.kill()
-                outs, _ = self.bot_subprocess.communicate()
-                self.bytes_queue.put(outs)
-        with open(self.stdout_path, 'wb') as log_file:
-            bytes_written = 0
-            for output in self.bytes_queue.queue:
-                try:
-                    bytes_written += log_file.write(output)
-                    if bytes_written >= PLAYER_LOG_SIZE_LIMIT:
-                        break
-                except TypeError:
-                    pass
+                self.bot_subprocess.wait()
+        if self.output_thread is not None:
+            # the pipe closes when the bot exits, unless it left children holding it
+            self.output_thread.join(timeout=CONNECT_TIMEOUT)
+        self.output.close()
+
+    def adopt(self, other):
+        '''
+        Takes over the running pokerbot of a player from an earlier match.
+        '''
+        self.bot_subprocess = other.bot_subprocess
+        self.connection = other.connection
+        self.socketfile = other.socketfile
+        self.output_thread = other.output_thread
+        self.protocol = other.protocol
+        self.reusable = other.reusable
+        # the output thread keeps writing to the capture it was started with
+        self.output.close()
+        self.output = other.output
+        self.output.reopen(self.stdout_path)
+
+    def pump_output(self, out):
+        '''
+        Drains the pokerbot's output pipe into the capture so it never blocks.
+        '''
+        try:
+            while chunk := out.read1(65536):
+                self.output.write(chunk)
+        except (ValueError, OSError):
+            pass
 
     def append(self, msg):
         self.messages.append(msg)
 
-    def query(self, round_state, game_log, *, wait=True):
-        legal_actions = round_state.legal_actions() if isinstance(round_state, RoundState) else set()
-        if self.socketfile is not None and (self.game_clock > 0. or not wait):
+    def query(self, record, game_log, *, wait=True):
+        '''
+        Asks the pokerbot for its action. Returns None if it did not send a
+        legal one in time.
+        '''
+        legal_actions = record.legal_actions() if isinstance(record, MatchRecord) else set()
+        self.latency = float('nan')
+        if ((self.socketfile is not None or self.local_bot is not None)
+            and (self.game_clock > 0. or not wait)
+        ):
             clause = ''
             try:
-                self.messages[0] = message(
-                    'time',
-                    time = round(self.game_clock, 3),
-                )
-                packet = json.dumps(self.messages)
-                del self.messages[1:]  # do not duplicate messages
-                self.message_log.append(packet)
-                start_time = time.perf_counter()
-                self.socketfile.write(packet + '\n')
-                self.socketfile.flush()
-                if not wait:
-                    return None
-                response = self.socketfile.readline().strip()
-                end_time = time.perf_counter()
-                self.response_log.append(response)
-                if ENFORCE_GAME_CLOCK:
-                    self.game_clock -= end_time - start_time
-                if self.game_clock <= 0.:
-                    raise socket.timeout
-                
-                action = None
-                
-                if (len(response) > 0
-                    and (response[0] == '[' or response[0] == '{')
-                ):
-                    # okay to accept a single json object
-                    if response[0] == '{':
-                        response = f'[{response}]'
-                    for response in json.loads(response):
-                        try:
-                            match response['type']:
-                                case 'action':
-                                    match response['action']['verb']:
-                                        case 'R':
-                                            action = RockAction
-                                        case 'P':
-                                            action = PaperAction
-                                        case 'S':
-                                            action = ScissorsAction
-                                        case _:
-                                            print(f'WARN Bad action verb from {self.name}: {response}')
-                                case _:
-                                    print(f"WARN Bad message type from {self.name}: {response}")
-                        except KeyError as e:
-                            print(f'WARN Message from {self.name} missing required field "{e}": {response}')
-                            continue
+                if self.local_bot is not None:
+                    self.messages[0] = message(
+                        'time',
+                        time = round(self.game_clock, 3),
+                    )
+                    start_time = time.perf_counter()
+                    try:
+                        action = self.local_bot.query(self.messages)
+                    except Exception as e:
+                        # a bot that raises is treated like a subprocess that crashed
+                        traceback.print_exc()
+                        raise OSError(f'{self.name} raised {e!r}') from e
+                    end_time = time.perf_counter()
+                    del self.messages[1:]  # do not duplicate messages
+                    if not wait:
+                        return None
+                    self.response_log.append(repr(action))
                 else:
-                    if len(response) == 0:
-                        print(f'WARN Bad message from {self.name} (empty)')
+                    packet = self.packet()
+                    self.set_deadline(wait)
+                    start_time = time.perf_counter()
+                    self.socketfile.write(packet)
+                    self.socketfile.flush()
+                    if not wait:
+                        return None
+                    if self.protocol == 'compact':
+                        response = self.socketfile.read(1).decode()
                     else:
-                        print(f'WARN Bad message format from {self.name} (expected json or list of json): {response}')
-                
-                if action in legal_actions:
-                    return action()
-                elif action is None:
-                    game_log.append(self.name + ' did not respond')
-                else:
-                    game_log.append(self.name + ' attempted illegal ' + action.__name__)
+                        response = self.socketfile.readline().decode().strip()
+                    end_time = time.perf_counter()
+                    self.response_log.append(response)
+                elapsed = end_time - start_time
+                if self.match_id is not None and self.socketfile.service_time is not None:
+                    # a shared process also answers other matches; only its time on this one counts
+                    elapsed = min(elapsed, self.socketfile.service_time)
+                # charged before parsing, so a misformatted response still costs its time
+                self.charge(elapsed)
+                if self.local_bot is None:
+                    action = self.parse_response(response)
+                action = self.resolve(action, legal_actions, game_log)
+                if action is not None:
+                    return action
             except socket.timeout:
                 error_message = self.name + ' ran out of time'
-                game_log.append(error_message)
+                if game_log is not None:
+                    game_log.append(error_message)
                 print(error_message)
                 self.game_clock = 0.
             except OSError:
                 error_message = self.name + ' disconnected'
-                if game_log:
+                if game_log is not None:
                     game_log.append(error_message)
                 print(error_message)
                 self.game_clock = 0.
-            except (IndexError, KeyError, ValueError):
+            except (IndexError, KeyError, TypeError, ValueError):
                 game_log.append(f'Response from {self.name} misformatted: ' + str(clause))
-        return random.choice([RockAction(), PaperAction(), ScissorsAction()])
+        return None
+
+    def set_deadline(self, wait):
+        '''
+        Bounds the socket operations of the next query by the pokerbot's
+        remaining clock, so a hung pokerbot costs only the time it has left.
+        '''
+        if self.connection is None:
+            return
+        if not wait:
+            self.connection.settimeout(CONNECT_TIMEOUT if self.game_clock > 0. else HUNG_BOT_TIMEOUT)
+        elif ENFORCE_GAME_CLOCK:
+            self.connection.settimeout(self.game_clock)
+        else:
+            self.connection.settimeout(CONNECT_TIMEOUT)
+
+    def hello(self):
+        '''
+        Builds the hello message, offering the configured protocol.
+        '''
+        if self.offered_protocol == 'json':
+            return message('hello')
+        return message('hello', protocols=[self.offered_protocol])
+
+    def packet(self):
+        '''
+        Encodes the pending messages into a packet for the pokerbot.
+        '''
+        self.messages[0] = message(
+            'time',
+            time = round(self.game_clock, 3),
+        )
+        text, packet = self.encode_packet()
+        self.message_log.append(text)
+        del self.messages[1:]  # do not duplicate messages
+        return packet
+
+    def encode_packet(self):
+        '''
+        Serializes the pending messages. Returns the text to log and the
+        bytes to send.
+        '''
+        if self.protocol == 'compact':
+            packet = self.compact_packet()
+            return packet.hex(), packet
+        messages = self.messages
+        if self.match_id is not None:
+            # copies, as the two seats share their action messages
+            messages = [{**msg, 'match': self.match_id} for msg in messages]
+        text = json.dumps(messages)
+        return text, (text + '\n').encode()
+
+    def compact_packet(self):
+        '''
+        Encodes the pending messages as compact frames: one per payoff, the
+        last of which asks for an action or says goodbye.
+        '''
+        clock = self.messages[0]['time']
+        verbs = [NO_VERB, NO_VERB]
+        results = []
+        tag = b'A'
+        for msg in self.messages[1:]:
+            match msg['type']:
+                case 'info':
+                    self.seat = msg['info']['seat']
+                case 'action':
+                    verbs[msg['seat']] = msg['action']['verb'].encode()
+                case 'payoff':
+                    results.append((verbs[self.seat], verbs[1 - self.seat], msg['payoff']))
+                case 'new_match':
+                    tag = b'N'
+                case 'goodbye':
+                    tag = b'G'
+        frames = [COMPACT_FRAME.pack(b'U', clock, *result) for result in results[:-1]]
+        frames.append(COMPACT_FRAME.pack(tag, clock, *(results[-1] if results else (NO_VERB, NO_VERB, 0))))
+        return b''.join(frames)
+
+    def charge(self, elapsed):
+        '''
+        Charges a round trip to the game clock. Raises socket.timeout if the
+        pokerbot has run out of time.
+        '''
+        self.latency = elapsed
+        self.latencies.add(elapsed)
+        if ENFORCE_GAME_CLOCK:
+            self.game_clock -= elapsed
+        if self.game_clock <= 0.:
+            raise socket.timeout
+
+    def resolve(self, action, legal_actions, game_log):
+        '''
+        Checks the action the pokerbot responded with. Returns the action to
+        play, or None if the pokerbot did not respond with a legal action.
+        '''
+        if action in legal_actions:
+            return action()
+        elif action is None:
+            game_log.append(self.name + ' did not respond')
+        else:
+            game_log.append(self.name + ' attempted illegal ' + action.__name__)
+        return None
+
+    def parse_response(self, response):
+        '''
+        Decodes a response line from the pokerbot into an action class, or
+        None if it did not contain one.
+        '''
+        action = None
+        
+        if self.protocol == 'compact':
+            if response in DECODE:
+                return DECODE[response]
+            print(f'WARN Bad compact reply from {self.name}: {response!r}')
+            return None
+        
+        if (len(response) > 0
+            and (response[0] == '[' or response[0] == '{')
+        ):
+            # okay to accept a single json object
+            if response[0] == '{':
+                response = f'[{response}]'
+            for response in json.loads(response):
+                try:
+                    match response['type']:
+                        case 'action':
+                            match response['action']['verb']:
+                                case 'R':
+                                    action = RockAction
+                                case 'P':
+                                    action = PaperAction
+                                case 'S':
+                                    action = ScissorsAction
+                                case _:
+                                    print(f'WARN Bad action verb from {self.name}: {response}')
+                        case 'hello':
+                            if response.get('protocol') == self.offered_protocol:
+                                self.protocol = self.offered_protocol
+                            self.features = set(response.get('features', []))
+                            self.reusable = 'new_match' in self.features
+                        case _:
+                            print(f"WARN Bad message type from {self.name}: {response}")
+                except KeyError as e:
+                    print(f'WARN Message from {self.name} missing required field "{e}": {response}')
+                    continue
+        else:
+            if len(response) == 0:
+                print(f'WARN Bad message from {self.name} (empty)')
+            else:
+                print(f'WARN Bad message format from {self.name} (expected json or list of json): {response}')
+        return action
+
+class BotPool():
+    '''
+    Pokerbots kept running between matches, for those that accept
+    new_match. At most size idle pokerbots are kept, and the least recently
+    used one is shut down to make room.
+    '''
+    _shared = None
+
+    _shared_lock = Lock()
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = []
+        self.lock = Lock()
+
+    @classmethod
+    def shared(cls):
+        '''
+        Returns the pool of this process, creating it on first use.
+        '''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(BOT_POOL_SIZE)
+                # also runs when a multiprocessing worker exits
+                Finalize(cls._shared, cls._shared.close, exitpriority=10)
+            return cls._shared
+
+    @staticmethod
+    def key(player):
+        return (os.path.realpath(player.path), player.offered_protocol, player.capture)
+
+    def acquire(self, player):
+        '''
+        Hands an idle pokerbot of the same bot to player. Returns whether
+        there was one.
+        '''
+        key = self.key(player)
+        while True:
+            with self.lock:
+                matches = [i for i, pooled in enumerate(self.idle) if self.key(pooled) == key]
+                if not matches:
+                    return False
+                pooled = self.idle.pop(matches[-1])
+            if pooled.bot_subprocess.poll() is None:
+                player.adopt(pooled)
+                return True
+            pooled.shutdown()
+
+    def release(self, player):
+        with self.lock:
+            self.idle.append(player)
+            evicted = self.idle[:-self.size] if len(self.idle) > self.size else []
+            del self.idle[:len(evicted)]
+        for pooled in evicted:
+            pooled.shutdown()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for pooled in idle:
+            pooled.shutdown()
+
+class MultiplexChannel():
+    '''
+    One match's view of a multiplexed pokerbot connection. Offers the file
+    methods Player.query uses; responses arrive through the connection's
+    reader thread, along with the time the bot spent on each.
+    '''
+
+    def __init__(self, connection, match_id):
+        self.connection = connection
+        self.match_id = match_id
+        self.responses = queue.Queue()
+        self.pending = []
+        self.timeout = CONNECT_TIMEOUT
+        self.sent_time = 0.
+        self.service_time = None
+
+    def write(self, packet):
+        self.pending.append(packet)
+
+    def flush(self):
+        packet = b''.join(self.pending)
+        self.pending.clear()
+        self.sent_time = time.perf_counter()
+        self.connection.send(packet)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def readline(self):
+        try:
+            line, self.service_time = self.responses.get(timeout=self.timeout)
+            return line
+        except queue.Empty:
+            raise socket.timeout
+
+    def close(self):
+        self.connection.close_match(self.match_id)
+
+class MultiplexConnection():
+    '''
+    One pokerbot process playing several matches at once. A host Player
+    owns the process, and a reader thread hands every response line to the
+    channel of the match it names.
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        self.channels = {}
+        self.match_ids = count()
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.closed = False
+        self.last_reply_time = 0.
+        # the reader waits on the connection for as long as it stays open
+        host.connection.settimeout(None)
+        self.reader = Thread(target=self.demux, daemon=True)
+        self.reader.start()
+
+    @classmethod
+    def start(cls, name, path, output_dir, *, capture, transport):
+        '''
+        Launches a pokerbot and shakes hands with it. Returns the connection,
+        or None if the pokerbot could not be launched or does not support
+        multiplex.
+        '''
+        host = Player(name, path, output_dir, capture=capture, transport=transport)
+        host.load_commands()
+        host.run()
+        if host.socketfile is not None:
+            host.messages[1:] = [message('hello', features=['multiplex'])]
+            try:
+                host.socketfile.write(host.packet())
+                host.socketfile.flush()
+                response = host.socketfile.readline().decode().strip()
+                host.response_log.append(response)
+                host.parse_response(response)
+            except (OSError, ValueError):
+                pass
+        if 'multiplex' not in host.features:
+            print(name, 'does not support multiplex, running it once per match')
+            host.shutdown()
+            return None
+        return cls(host)
+
+    def open_match(self):
+        '''
+        Returns the channel of a new match on this connection.
+        '''
+        with self.lock:
+            channel = MultiplexChannel(self, next(self.match_ids))
+            self.channels[channel.match_id] = channel
+        return channel
+
+    def close_match(self, match_id):
+        with self.lock:
+            self.channels.pop(match_id, None)
+
+    def send(self, packet):
+        with self.write_lock:
+            self.host.socketfile.write(packet)
+            self.host.socketfile.flush()
+
+    def demux(self):
+        '''
+        Routes every response line to the channel of its match. The bot
+        answers in order, so it started on a reply when the packet was sent
+        or when it finished the previous reply, whichever came later.
+        '''
+        try:
+            while line := self.host.socketfile.readline():
+                reply_time = time.perf_counter()
+                last_reply_time, self.last_reply_time = self.last_reply_time, reply_time
+                try:
+                    response = json.loads(line)
+                    match_id = (response[0] if isinstance(response, list) else response)['match']
+                except (ValueError, LookupError, TypeError):
+                    print(f'WARN Response from {self.host.name} names no match: {line!r}')
+                    continue
+                with self.lock:
+                    channel = self.channels.get(match_id)
+                if channel is not None:
+                    channel.responses.put((line, reply_time - max(channel.sent_time, last_reply_time)))
+        except (OSError, ValueError):
+            pass
+        finally:
+            # every waiting match sees the connection close
+            with self.lock:
+                self.closed = True
+                for channel in self.channels.values():
+                    channel.responses.put((b'', None))
+
+    def close(self):
+        self.host.shutdown()
+        self.reader.join(timeout=CONNECT_TIMEOUT)
+        self.host.message_log.close()
+        self.host.response_log.close()
+
+class Multiplexer():
+    '''
+    Shares one process per pokerbot between the matches running at once,
+    for bots that support multiplex.
+    '''
+
+    def __init__(self, output_dir, *, capture=True, transport=TRANSPORT):
+        self.output_dir = output_dir
+        self.capture = capture
+        self.transport = transport
+        self.connections = {}
+        self.lock = Lock()
+
+    def open(self, player):
+        '''
+        Returns a channel for player's match on the shared process of its
+        bot, launching it if needed, or None if the bot cannot be shared.
+        '''
+        key = os.path.realpath(player.path)
+        with self.lock:
+            connection = self.connections.get(key, False)
+            if connection is False or (connection is not None and connection.closed):
+                connection = MultiplexConnection.start(
+                    player.name,
+                    player.path,
+                    self.output_dir,
+                    capture = self.capture,
+                    transport = self.transport,
+                )
+                self.connections[key] = connection
+        return None if connection is None else connection.open_match()
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                if connection is not None:
+                    connection.close()
+            self.connections.clear()
+
+class BackgroundWriter():
+    '''
+    Finishes matches off the critical path of a multi-match runner: their
+    pokerbots are stopped and their logs written on worker threads while
+    the next match starts.
+    '''
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = set()
+        self.lock = Lock()
+
+    @classmethod
+    def shared(cls):
+        '''
+        Returns the writer of this process, creating it on first use.
+        '''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(BACKGROUND_WORKERS)
+                # runs before the bot pool is closed, and when a multiprocessing worker exits
+                Finalize(cls._shared, cls._shared.close, exitpriority=20)
+            return cls._shared
+
+    def submit(self, function, *args, **kwargs):
+        future = self.executor.submit(function, *args, **kwargs)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        if future.exception() is not None:
+            print('WARN Could not finish a match:', repr(future.exception()))
+
+    def wait(self):
+        '''
+        Blocks until every match submitted so far is finished.
+        '''
+        with self.lock:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def match_seed(seed, p1_name, p2_name):
+    '''
+    Derives the seed of a match from the seed of the run and the matchup,
+    so it does not depend on which matches ran before it or alongside it.
+    '''
+    digest = hashlib.sha256(f'{seed}:{p1_name}:{p2_name}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
 
 class Match():
     '''
@@ -395,40 +1380,60 @@ class Match():
         switch_seats=True,
         secrets=None,
         capture=True,
+        in_process=False,
+        concurrent_queries=True,
+        protocol='json',
+        transport='tcp',
+        log_compression=LOG_COMPRESSION,
+        profile=False,
+        build_cache=BUILD_CACHE_PATH,
+        zygote=False,
+        reuse_bots=False,
+        multiplexer=None,
+        background=False,
+        seed=SEED,
+        db=None,
     ):
-        global PLAYER_1_NAME, PLAYER_1_PATH, PLAYER_2_NAME, LOGS_PATH, PLAYER_2_PATH, NUM_ROUNDS
-        if p1 is not None:
-            PLAYER_1_NAME = p1[0]
-            PLAYER_1_PATH = p1[1]
-        if p2 is not None:
-            PLAYER_2_NAME = p2[0]
-            PLAYER_2_PATH = p2[1]
-        if output_path is not None:
-            LOGS_PATH = output_path
-        if n_rounds is not None:
-            NUM_ROUNDS = int(n_rounds)
+        self.p1 = tuple(p1) if p1 is not None else (PLAYER_1_NAME, PLAYER_1_PATH)
+        self.p2 = tuple(p2) if p2 is not None else (PLAYER_2_NAME, PLAYER_2_PATH)
+        self.output_path = output_path if output_path is not None else LOGS_PATH
+        self.n_rounds = int(n_rounds)
         self.switch_seats = switch_seats
         self.secrets = None if secrets is None else secrets.strip().split(',')
         assert self.secrets is None or len(self.secrets) == 2
         self.capture = capture
-        
-        self.log = ['Poker Camp Game Engine - RPS Hackathon @ Fractal - ' + PLAYER_1_NAME + ' vs ' + PLAYER_2_NAME]
+        self.in_process = in_process
+        self.concurrent_queries = concurrent_queries
+        self.protocol = protocol
+        self.transport = transport
+        self.log_compression = log_compression
+        self.profile = profile
+        self.build_cache = build_cache
+        self.zygote = zygote
+        self.reuse_bots = reuse_bots
+        self.multiplexer = multiplexer
+        self.background = background
+        self.seed = seed
+        self.random = random.Random(match_seed(seed, self.p1[0], self.p2[0]))
+        self.db = db
+        self.log = None
         
         self.held_action_messages = []
+        self.executor = None
+        self.record = None
 
-    def send_round_state(self, players, round_state):
+    def send_round_state(self, players):
         '''
-        Incorporates RoundState information into the game log and player messages.
+        Incorporates the start of a round into the game log and player messages.
         '''
-        if round_state.street == 0 and round_state.turn_number == 0:
-            for seat, player in enumerate(players):
-                self.log.append(f'{player.name} posts the ante of {ANTE}')
-            for seat, player in enumerate(players):
-                player.append(message('info', info={
-                        'seat': seat,
-                        **({'secret': self.secrets[seat]} if self.secrets else {}),
-                        'new_game': True,
-                }))
+        for seat, player in enumerate(players):
+            self.log.append(f'{player.name} posts the ante of {ANTE}')
+        for seat, player in enumerate(players):
+            player.append(message('info', info={
+                    'seat': seat,
+                    **({'secret': self.secrets[seat]} if self.secrets else {}),
+                    'new_game': True,
+            }))
 
     def send_action(self, players, seat, action):
         '''
@@ -450,77 +1455,248 @@ class Match():
             seat = seat,
         ))
 
-    def send_terminal_state(self, players, round_state):
+    def send_terminal_state(self, players, deltas):
         '''
-        Incorporates TerminalState information into the game log and player messages.
+        Incorporates the showdown into the game log and player messages.
         '''
-        previous_state = round_state.previous_state
         for seat, player in enumerate(players):
-            self.log.append(f'{player.name} awarded {round_state.deltas[seat]:+d}')
+            self.log.append(f'{player.name} awarded {deltas[seat]:+d}')
             for held_action_message in self.held_action_messages:
                 player.append(held_action_message)
             player.append(message(
                 'payoff',
-                payoff = round_state.deltas[seat],
+                payoff = deltas[seat],
             ))
         self.held_action_messages = []
 
+    def query_players(self, players, game_logs):
+        '''
+        Queries both seats for their action. Neither seat sees the other's
+        action before the showdown, so the second seat is queried on the
+        worker thread while the first is queried here. Each player's clock
+        only counts its own round trip.
+        '''
+        if self.executor is None:
+            return [player.query(self.record, game_log) for player, game_log in zip(players, game_logs)]
+        future = self.executor.submit(players[1].query, self.record, game_logs[1])
+        return [players[0].query(self.record, game_logs[0]), future.result()]
+
     def run_round(self, players):
-        round_state = RoundState.new()
-        while not isinstance(round_state, TerminalState):
-            self.send_round_state(players, round_state)
-            active = round_state.turn_number % 2
-            player = players[active]
-            action = player.query(
-                round_state,
-                self.log,
-            )
-            self.send_action(players, active, action)
-            round_state = round_state.proceed(action)
-        self.send_terminal_state(players, round_state)
-        for player, delta in zip(players, round_state.deltas):
+        self.send_round_state(players)
+        # each seat logs separately so the gamelog stays in seat order
+        game_logs = [[], []]
+        actions = self.query_players(players, game_logs)
+        self.play_actions(players, actions, game_logs)
+
+    def play_actions(self, players, actions, game_logs):
+        '''
+        Plays out a round from the actions both seats chose. A seat that
+        chose none plays a random action, drawn in seat order.
+        '''
+        actions = [
+            action if action is not None else self.random.choice(MatchRecord.ACTIONS)()
+            for action in actions
+        ]
+        for seat, action in enumerate(actions):
+            for line in game_logs[seat]:
+                self.log.append(line)
+            self.send_action(players, seat, action)
+        deltas = self.record.showdown(actions)
+        i = self.record.rounds_played - 1
+        self.round_records.append(
+            i + 1,
+            0 if players[0] is self.players[0] else 1,
+            (self.record.actions[0][i], self.record.actions[1][i]),
+            deltas,
+            (players[0].latency, players[1].latency),
+        )
+        self.send_terminal_state(players, deltas)
+        for player, delta in zip(players, deltas):
             player.bankroll += delta
 
     def run(self):
         '''
-        Runs one matchup.
+        Runs one matchup. Returns the (name, score) pair of each player, in p1, p2 order.
         '''
-        print('Starting the game engine...')
-        MATCH_DIR = f'{LOGS_PATH}/{PLAYER_1_NAME}.{PLAYER_2_NAME}'
-        Path(MATCH_DIR).mkdir(parents=True, exist_ok=True)
-        players = [
-            Player(PLAYER_1_NAME, PLAYER_1_PATH, MATCH_DIR, capture=self.capture, ),
-            Player(PLAYER_2_NAME, PLAYER_2_PATH, MATCH_DIR, capture=self.capture, ),
-        ]
-        for player in players:
-            player.build()
-            player.run()
-        for round_num in range(1, NUM_ROUNDS + 1):
-            self.log.append('')
-            self.log.append('Round #' + str(round_num) + STATUS(players))
-            self.run_round(players)
-            if self.switch_seats:
-                players = players[::-1]
+        players = self.create_players(
+            Player,
+            in_process = self.in_process,
+            protocol = self.protocol,
+            transport = self.transport,
+            zygote = Zygote.shared() if self.zygote else None,
+            pool = BotPool.shared() if self.reuse_bots else None,
+            multiplexer = self.multiplexer,
+        )
+        self.record = MatchRecord(self.n_rounds)
+        try:
+            self.start_players(players)
+            if self.concurrent_queries and all(player.local_bot is None for player in players):
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            profiler = None
+            if self.profile:
+                profiler = PhaseProfiler()
+                profiler.instrument_match(self, players)
+            start_time = time.perf_counter()
+            for round_num in range(1, self.n_rounds + 1):
+                self.log.append('')
+                self.log.append('Round #' + str(round_num) + STATUS(players))
+                self.run_round(players)
+                if self.switch_seats:
+                    players = players[::-1]
+        except:
+            self.abort()
+            raise
+        elapsed = time.perf_counter() - start_time
         self.log.append('')
         self.log.append('Final' + STATUS(players))
-        for i, player in enumerate(players):
-            player.stop(i)
-            
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        profile_summary = profiler.summary(elapsed, self.n_rounds) if profiler is not None else None
+        if not self.background:
+            self.finish(players, profile_summary, stop=True)
+        else:
+            if self.reuse_bots:
+                # pooled bots must be back in the pool before the next match starts
+                self.stop_players(players)
+            BackgroundWriter.shared().submit(self.finish, players, profile_summary, stop=not self.reuse_bots)
+        return self.scores()
+
+    def abort(self):
+        '''
+        Stops both pokerbots of a match that failed. Neither is trusted to
+        play another match, so they are shut down rather than pooled.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for player in self.players:
+            player.game_clock = 0.
+        self.stop_players(self.players)
+
+    def finish(self, players, profile_summary, *, stop):
+        '''
+        Stops both pokerbots if asked to and writes the logs of the match.
+        '''
+        if stop:
+            self.stop_players(players)
+        self.write_logs(players)
+        if profile_summary is not None:
+            self.write_profile(profile_summary)
+
+    def stop_players(self, players):
+        '''
+        Stops both pokerbots at once, so a slow one only costs its own wait.
+        '''
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(Player.stop, players, range(len(players))))
+
+    def scores(self):
+        '''
+        Returns the (name, score) pair of each player in p1, p2 order, however
+        the seats ended up.
+        '''
+        return [(p.name, p.bankroll*100.0/self.n_rounds) for p in self.players]
+
+    def write_profile(self, summary):
+        '''
+        Prints the per-phase breakdown of a profiled match and writes it
+        next to the scores.
+        '''
+        (p1_name, _), (p2_name, _) = self.p1, self.p2
+        print(PhaseProfiler.report(summary))
+        with open(f'{self.output_path}/{PROFILE_FILENAME}.{p1_name}.{p2_name}.json', 'w') as profile_file:
+            json.dump(summary, profile_file, indent=2)
+
+    def start_players(self, players):
+        '''
+        Builds, launches and connects both players at once. Returns when
+        both are connected or have given up.
+        '''
+        cache = BuildCache(self.build_cache) if self.build_cache is not None else None
+        if self.in_process:
+            # in-process bots are imported through the shared sys.modules
+            for player in players:
+                player.build(cache)
+                player.run()
+            return
+        if Path(players[0].path).resolve() == Path(players[1].path).resolve():
+            # one directory must not be built twice at once; the second build is cached
+            for player in players:
+                player.build(cache)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(Player.run, players))
+            return
+
+        def start(player):
+            player.build(cache)
+            player.run()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(start, players))
+
+    def create_players(self, player_class, **kwargs):
+        '''
+        Creates the match directory and both players.
+        '''
+        print('Starting the game engine...')
+        self.match_dir = f'{self.output_path}/{self.p1[0]}.{self.p2[0]}'
+        Path(self.match_dir).mkdir(parents=True, exist_ok=True)
+        self.log = LogWriter(f'{self.match_dir}/{GAME_LOG_FILENAME}.txt', compression=self.log_compression)
+        self.log.append('Poker Camp Game Engine - RPS Hackathon @ Fractal - ' + self.p1[0] + ' vs ' + self.p2[0])
+        self.round_records = RecordWriter(f'{self.match_dir}/{ROUNDS_FILENAME}.bin', buffer_size=LOG_BUFFER_SIZE)
+        self.players = [
+            player_class(name, path, self.match_dir, capture=self.capture, log_compression=self.log_compression, **kwargs)
+            for name, path in [self.p1, self.p2]
+        ]
+        return self.players
+
+    def write_logs(self, players):
+        '''
+        Finishes the game log and message transcripts and writes the scores
+        of a finished match. Returns the (name, score) pair of each player.
+        '''
         print('Writing logs...')
+        (p1_name, _), (p2_name, _) = self.p1, self.p2
         
-        with open(f'{MATCH_DIR}/{GAME_LOG_FILENAME}.txt', 'w') as log_file:
-            log_file.write('\n'.join(self.log))
-        for active, name in [
-            (0, PLAYER_1_NAME),
-            (1, PLAYER_2_NAME),
-        ]:
-            with open(f'{MATCH_DIR}/{name}.msg.server.txt', 'w') as log_file:
-                log_file.write('\n'.join(players[active].message_log))
-            with open(f'{MATCH_DIR}/{name}.msg.player.txt', 'w') as log_file:
-                log_file.write('\n'.join(players[active].response_log))
+        self.log.close()
+        self.round_records.close()
+        for player in players:
+            player.message_log.close()
+            player.response_log.close()
         
-        with open(f'{LOGS_PATH}/{SCORE_FILENAME}.{PLAYER_1_NAME}.{PLAYER_2_NAME}.txt', 'w') as score_file:
-            score_file.write('\n'.join([f'{p.name},{p.bankroll*100.0/NUM_ROUNDS}' for p in players]))
+        scores = self.scores()
+        with open(f'{self.output_path}/{SCORE_FILENAME}.{p1_name}.{p2_name}.txt', 'w') as score_file:
+            score_file.write('\n'.join([f'{name},{score}' for name, score in scores]))
+        with open(f'{self.output_path}/{LATENCY_FILENAME}.{p1_name}.{p2_name}.json', 'w') as latency_file:
+            json.dump({
+                p.name: {
+                    **p.latencies.summary(),
+                    'clock_used': STARTING_GAME_CLOCK - max(p.game_clock, 0.),
+                    'clock_remaining': max(p.game_clock, 0.),
+                }
+                for p in players
+            }, latency_file, indent=2)
+        if self.db is not None:
+            self.record_result(scores)
+        return scores
+
+    def record_result(self, scores):
+        '''
+        Writes the result of the match to the results database.
+        '''
+        with open(f'{self.match_dir}/{ROUNDS_FILENAME}.bin', 'rb') as rounds_file:
+            rounds = rounds_file.read()
+        ResultsDB(self.db).record_match(
+            p1 = (self.p1[0], hash_bot(self.p1[1])),
+            p2 = (self.p2[0], hash_bot(self.p2[1])),
+            scores = scores,
+            rounds = rounds,
+            seed = self.seed,
+            n_rounds = self.n_rounds,
+            switch_seats = self.switch_seats,
+            engine_version = ENGINE_VERSION,
+        )
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Game engine with optional player arguments")
@@ -531,10 +1707,22 @@ if __name__ == '__main__':
     parser.add_argument("--switch-seats", default=False, action=argparse.BooleanOptionalAction, help='Do players switch seats between rounds')
     parser.add_argument("--secrets", metavar=('STR,STR'), help='Secret info given to players at start of round')
     parser.add_argument("--capture", default=False, action=argparse.BooleanOptionalAction, help='Capture player outputs and write them to log files')
+    parser.add_argument("--in-process", default=False, action=argparse.BooleanOptionalAction, help='Import trusted Python bots into the engine process instead of running them as subprocesses')
+    parser.add_argument("--concurrent-queries", default=True, action=argparse.BooleanOptionalAction, help='Query both seats at the same time each round')
+    parser.add_argument("--protocol", default=PROTOCOL, choices=['json', 'compact'], help='Wire protocol to offer players at hello')
+    parser.add_argument("--transport", default=TRANSPORT, choices=sorted(TRANSPORTS), help='How players connect to the engine')
+    parser.add_argument("--log-compression", default=LOG_COMPRESSION, choices=sorted(LogWriter.OPENERS), help='Compress game logs and message transcripts as they are written')
+    parser.add_argument("--build-cache", default=BUILD_CACHE_PATH, metavar='PATH', help='Skip builds of bots whose directory matches a cached build')
+    parser.add_argument("--no-build-cache", dest='build_cache', action='store_const', const=None, help='Always run the build commands')
+    parser.add_argument("--zygote", default=False, action=argparse.BooleanOptionalAction, help='Fork python3 player.py bots from a pre-warmed interpreter')
+    parser.add_argument("--seed", type=int, default=SEED, metavar='INT', help='Seed of the random actions played for bots that fail to act')
+    parser.add_argument("--profile", default=False, action=argparse.BooleanOptionalAction, help='Time the engine phases of every round and report where the time went')
+    parser.add_argument("--db", metavar='PATH', help='Also write the result to this SQLite results database')
+    parser.add_argument("--profile-output", metavar='PATH', help='Also run the match under cProfile and dump pstats to PATH')
 
     args = parser.parse_args()
     
-    Match(
+    match = Match(
         p1 = args.p1,
         p2 = args.p2,
         output_path = args.output,
@@ -542,4 +1730,20 @@ if __name__ == '__main__':
         switch_seats = args.switch_seats,
         secrets = args.secrets,
         capture = args.capture,
-    ).run()
+        in_process = args.in_process,
+        concurrent_queries = args.concurrent_queries,
+        protocol = args.protocol,
+        transport = args.transport,
+        log_compression = args.log_compression,
+        profile = args.profile,
+        build_cache = args.build_cache,
+        zygote = args.zygote,
+        seed = args.seed,
+        db = args.db,
+    )
+    if args.profile_output:
+        stats_profiler = cProfile.Profile()
+        stats_profiler.runcall(match.run)
+        stats_profiler.dump_stats(args.profile_output)
+    else:
+        match.run()
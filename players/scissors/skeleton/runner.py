@@ -4,105 +4,218 @@ The infrastructure for interacting with the engine.
 import argparse
 import json
 import socket
+import struct
 from .actions import RockAction, PaperAction, ScissorsAction
 from .bot import Bot
 
+# A compact frame is a tag byte (A: act, U: results only, N: new match,
+# G: goodbye), the match clock, my verb, their verb and my payoff. The verbs are b'-' when the
+# frame carries no results. Each A frame is answered with a single verb byte.
+FRAME = struct.Struct('<cfccb')
+DECODE = {b'R': RockAction, b'P': PaperAction, b'S': ScissorsAction}
+
 class Runner():
     '''
     Interacts with the engine.
     '''
 
-    def __init__(self, bot, socketfile):
+    def __init__(self, bot, socketfile, match_id=None):
         self.bot = bot
         self.socketfile = socketfile
+        self.match_id = match_id
+        self.matches = {}
+        self.match_clock = None
+        self.results = [None, None]
+        self.seat = 0
+        self.protocol = 'json'
+        self.replies = []
+        self.connected = True
 
     def receive(self):
         '''
         Generator for incoming messages from the engine.
         '''
         while True:
-            packet = self.socketfile.readline().strip()
+            packet = self.socketfile.readline().decode().strip()
             if not packet:
                 break
             yield packet
 
-    def send(self, action, seat):
+    @staticmethod
+    def encode(action):
         '''
-        Encodes an action and sends it to the engine.
+        Returns the verb for an action.
         '''
         match action:
             case RockAction():
-                verb = 'R'
+                return 'R'
             case PaperAction():
-                verb = 'P'
+                return 'P'
             case ScissorsAction():
-                verb = 'S'
+                return 'S'
             case _:
                 raise ValueError(f'Bad action type: {action}')
-        self.socketfile.write(json.dumps({
+
+    def send(self, action, seat):
+        '''
+        Encodes an action and sends it to the engine.
+        '''
+        if self.protocol == 'compact':
+            self.socketfile.write(self.encode(action).encode())
+            self.socketfile.flush()
+            return
+        reply = {
             'type': 'action',
-            'action': {'verb': verb},
+            'action': {'verb': self.encode(action)},
             'player': seat,
-        }) + '\n')
+        }
+        if self.match_id is not None:
+            reply['match'] = self.match_id
+        if self.replies:
+            reply = self.replies + [reply]
+            self.replies = []
+        self.socketfile.write((json.dumps(reply) + '\n').encode())
         self.socketfile.flush()
 
+    def send_replies(self):
+        '''
+        Sends the pending replies on their own.
+        '''
+        self.socketfile.write((json.dumps(self.replies) + '\n').encode())
+        self.socketfile.flush()
+        self.replies = []
+
+    def new_match(self):
+        '''
+        Starts the next match on the same connection with a fresh bot.
+        '''
+        self.bot = type(self.bot)()
+        self.results = [None, None]
+
+    def handle(self, messages):
+        '''
+        Applies one packet of messages to the game and asks the bot for its
+        next action. Returns None if no action is expected: for a hello
+        handshake, at the end of a match, or once the engine says goodbye.
+        '''
+        for message in messages:
+            try:
+                match message['type']:
+                    case 'hello':
+                        reply = {'type': 'hello', 'features': ['new_match', 'multiplex']}
+                        if 'compact' in message.get('protocols', []):
+                            reply['protocol'] = 'compact'
+                        self.replies.append(reply)
+                    
+                    case 'time':
+                        self.match_clock = float(message['time'])
+                    
+                    case 'info':
+                        info = message['info']
+                        self.seat = int(info['seat'])
+                        if 'new_game' in info and info['new_game']:
+                            self.results = [None, None]
+                    
+                    case 'action':
+                        match message['action']['verb']:
+                            case 'R':
+                                self.results[message['seat']] = RockAction()
+                            case 'P':
+                                self.results[message['seat']] = PaperAction()
+                            case 'S':
+                                self.results[message['seat']] = ScissorsAction()
+                            case _:
+                                print(f'WARN Bad action type: {message}')
+                    
+                    case 'payoff':
+                        payoff = message['payoff']
+                        self.bot.handle_results(
+                            my_action = self.results[self.seat],
+                            their_action = self.results[1-self.seat],
+                            my_payoff = payoff,
+                            match_clock = self.match_clock,
+                        )
+                    
+                    case 'new_match':
+                        self.new_match()
+                        return None
+                    
+                    case 'goodbye':
+                        self.connected = False
+                        return None
+                
+                    case _:
+                        print(f"WARN Bad message type: {message}")
+                    
+            except KeyError as e:
+                print(f'WARN Message missing required field "{e}": {message}')
+                continue
+        if all(message.get('type') in ('time', 'hello') for message in messages):
+            # a packet of nothing but hello is a handshake, answered by our hello
+            return None
+        return self.bot.get_action(match_clock = self.match_clock)
+
+    def dispatch(self, messages):
+        '''
+        Hands a packet of a multiplexed match to the Runner playing it, which
+        is started with a fresh bot on the match's first packet.
+        '''
+        match_id = messages[0]['match']
+        runner = self.matches.get(match_id)
+        if runner is None:
+            runner = self.matches[match_id] = Runner(type(self.bot)(), self.socketfile, match_id)
+        action = runner.handle(messages)
+        if action is None:
+            del self.matches[match_id]
+        else:
+            runner.send(action, runner.seat)
+
     def run(self):
         '''
         Reconstructs the game based on the actions received from the engine.
         '''
-        match_clock = None
-        results = [None, None]
-        seat = 0
         for packet in self.receive():
             # okay to accept a single json object
             if packet[0] == '{':
                 packet = f'[{packet}]'
-            for message in json.loads(packet):
-                try:
-                    match message['type']:
-                        case 'hello':
-                            pass
-                        
-                        case 'time':
-                            match_clock = float(message['time'])
-                        
-                        case 'info':
-                            info = message['info']
-                            seat = int(info['seat'])
-                            if 'new_game' in info and info['new_game']:
-                                results = [None, None]
-                        
-                        case 'action':
-                            match message['action']['verb']:
-                                case 'R':
-                                    results[message['seat']] = RockAction()
-                                case 'P':
-                                    results[message['seat']] = PaperAction()
-                                case 'S':
-                                    results[message['seat']] = ScissorsAction()
-                                case _:
-                                    print(f'WARN Bad action type: {message}')
-                        
-                        case 'payoff':
-                            payoff = message['payoff']
-                            self.bot.handle_results(
-                                my_action = results[seat],
-                                their_action = results[1-seat],
-                                my_payoff = payoff,
-                                match_clock = match_clock,
-                            )
-                        
-                        case 'goodbye':
-                            return
-                    
-                        case _:
-                            print(f"WARN Bad message type: {message}")
-                        
-                except KeyError as e:
-                    print(f'WARN Message missing required field "{e}": {message}')
+            messages = json.loads(packet)
+            if messages and 'match' in messages[0]:
+                self.dispatch(messages)
+                continue
+            action = self.handle(messages)
+            if action is None:
+                if self.replies:
+                    self.send_replies()
+                if self.connected:
                     continue
-            action = self.bot.get_action(match_clock = match_clock)
-            self.send(action, seat)
+                return
+            switch = any(reply.get('protocol') == 'compact' for reply in self.replies)
+            self.send(action, self.seat)
+            if switch:
+                # the engine switches to compact frames once it sees our hello
+                self.protocol = 'compact'
+                return self.run_compact()
+
+    def run_compact(self):
+        '''
+        Reconstructs the game from compact frames.
+        '''
+        while len(frame := self.socketfile.read(FRAME.size)) == FRAME.size:
+            tag, self.match_clock, my_verb, their_verb, payoff = FRAME.unpack(frame)
+            if my_verb in DECODE:
+                self.bot.handle_results(
+                    my_action = DECODE[my_verb](),
+                    their_action = DECODE[their_verb](),
+                    my_payoff = payoff,
+                    match_clock = self.match_clock,
+                )
+            match tag:
+                case b'A':
+                    self.send(self.bot.get_action(match_clock = self.match_clock), self.seat)
+                case b'N':
+                    self.new_match()
+                case b'G':
+                    return
 
 def parse_args():
     '''
@@ -110,8 +223,13 @@ def parse_args():
     '''
     parser = argparse.ArgumentParser(prog='python3 player.py')
     parser.add_argument('--host', type=str, default='localhost', help='Host to connect to, defaults to localhost')
-    parser.add_argument('port', type=int, help='Port on host to connect to')
-    return parser.parse_args()
+    parser.add_argument('--unix', type=str, metavar='PATH', help='Unix domain socket to connect to instead of a port')
+    parser.add_argument('--fd', type=int, help='Inherited connected socket to use instead of a port')
+    parser.add_argument('port', type=int, nargs='?', help='Port on host to connect to')
+    args = parser.parse_args()
+    if args.port is None and args.unix is None and args.fd is None:
+        parser.error('one of port, --unix or --fd is required')
+    return args
 
 def run_bot(bot, args):
     '''
@@ -119,11 +237,18 @@ def run_bot(bot, args):
     '''
     assert isinstance(bot, Bot)
     try:
-        sock = socket.create_connection((args.host, args.port))
+        if args.fd is not None:
+            sock = socket.socket(fileno=args.fd)
+        elif args.unix is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(args.unix)
+        else:
+            sock = socket.create_connection((args.host, args.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     except OSError:
-        print('Could not connect to {}:{}'.format(args.host, args.port))
+        print('Could not connect to {}'.format(args.fd or args.unix or f'{args.host}:{args.port}'))
         return
-    socketfile = sock.makefile('rw')
+    socketfile = sock.makefile('rwb')
     runner = Runner(bot, socketfile)
     runner.run()
     socketfile.close()
@@ -0,0 +1,103 @@
+'''
+Fixed-width binary round records.
+
+A records file is a HEADER followed by one RECORD per round, all
+little-endian:
+round : UINT32 round number, starting at 1
+order : UINT8 0 if the first named player sat in seat 0, else 1
+action0, action1 : INT8 action code of each seat (0 rock, 1 paper, 2 scissors)
+delta0, delta1 : INT8 payoff of each seat
+latency0, latency1 : FLOAT32 response time of each seat in seconds, NaN if
+  the seat was not asked
+
+read_records memory-maps a file as a NumPy structured array, so each field
+is a column that can be sliced without parsing. NumPy is an optional
+dependency needed only by read_records (pip install numpy); the engine and
+every other function here run without it. iter_records unpacks the
+contents of a file without NumPy, and column slices out a one-byte field.
+'''
+import os
+import struct
+
+HEADER = struct.Struct('<6sH')
+MAGIC = b'RPSREC'
+VERSION = 1
+RECORD = struct.Struct('<IBbbbbff')
+FIELDS = [
+    ('round', '<u4'),
+    ('order', 'u1'),
+    ('action0', 'i1'),
+    ('action1', 'i1'),
+    ('delta0', 'i1'),
+    ('delta1', 'i1'),
+    ('latency0', '<f4'),
+    ('latency1', '<f4'),
+]
+
+class RecordWriter():
+    '''
+    Appends round records to a file, writing them out in chunks.
+    '''
+
+    def __init__(self, path, *, buffer_size=65536):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+
+    def append(self, round_num, order, actions, deltas, latencies):
+        self.buffer += RECORD.pack(round_num, order, *actions, *deltas, *latencies)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def column(data, field):
+    '''
+    Returns the bytes of a one-byte field of every record in the contents of
+    a records file, without unpacking the records.
+    '''
+    offset = 0
+    for (name, _), code in zip(FIELDS, RECORD.format[1:]):
+        size = struct.calcsize('<' + code)
+        if name == field:
+            assert size == 1
+            return data[HEADER.size + offset::RECORD.size]
+        offset += size
+    raise KeyError(field)
+
+def iter_records(data):
+    '''
+    Iterates over the records in the contents of a records file, yielding
+    one tuple of RECORD fields per round.
+    '''
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'not a version {VERSION} records file')
+    return RECORD.iter_unpack(memoryview(data)[HEADER.size:])
+
+def read_records(path):
+    '''
+    Memory-maps a records file. Returns a read-only NumPy structured array
+    with one element per round and one field per RECORD column. Needs
+    NumPy.
+    '''
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError('read_records needs NumPy, install it with pip install numpy') from e
+    with open(path, 'rb') as records_file:
+        magic, version = HEADER.unpack(records_file.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a version {VERSION} records file')
+    dtype = np.dtype(FIELDS)
+    assert dtype.itemsize == RECORD.size
+    if os.path.getsize(path) == HEADER.size:
+        return np.zeros(0, dtype=dtype)  # empty files cannot be mapped
+    return np.memmap(path, dtype=dtype, mode='r', offset=HEADER.size)
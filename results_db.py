@@ -0,0 +1,190 @@
+'''
+SQLite store of match results.
+
+Every finished match is written in one transaction:
+bots -> name : TEXT, one row per bot name
+versions -> bot_id, hash : TEXT of the bot directory (see engine.hash_bot),
+  first_seen, last_seen : REAL unix times the version played
+matches -> p1_version, p2_version, seed, n_rounds, switch_seats,
+  engine_version, finished : REAL unix time
+match_players -> match_id, seat : 0 for p1, 1 for p2, version_id, score,
+  and per-round aggregates over the match: rounds won, lost and tied, the
+  number of times each action was played, and the mean and max latency
+
+The leaderboard is one query over match_players, restricted to matches
+between the latest version of each bot.
+'''
+from contextlib import closing
+import math
+import sqlite3
+import time
+
+from records import iter_records
+
+# concurrent writers wait this long in seconds for the database lock
+TIMEOUT = 30.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bots (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    bot_id INTEGER NOT NULL REFERENCES bots(id),
+    hash TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    UNIQUE (bot_id, hash)
+);
+CREATE INDEX IF NOT EXISTS versions_last_seen ON versions(bot_id, last_seen);
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    p1_version INTEGER NOT NULL REFERENCES versions(id),
+    p2_version INTEGER NOT NULL REFERENCES versions(id),
+    seed INTEGER NOT NULL,
+    n_rounds INTEGER NOT NULL,
+    switch_seats INTEGER NOT NULL,
+    engine_version INTEGER NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS matches_versions ON matches(p1_version, p2_version);
+CREATE TABLE IF NOT EXISTS match_players (
+    match_id INTEGER NOT NULL REFERENCES matches(id),
+    seat INTEGER NOT NULL,
+    version_id INTEGER NOT NULL REFERENCES versions(id),
+    score REAL NOT NULL,
+    rounds_won INTEGER NOT NULL,
+    rounds_lost INTEGER NOT NULL,
+    rounds_tied INTEGER NOT NULL,
+    rock INTEGER NOT NULL,
+    paper INTEGER NOT NULL,
+    scissors INTEGER NOT NULL,
+    mean_latency REAL,
+    max_latency REAL,
+    PRIMARY KEY (match_id, seat)
+);
+CREATE INDEX IF NOT EXISTS match_players_version ON match_players(version_id);
+'''
+
+LEADERBOARD_QUERY = '''
+WITH latest AS (
+    SELECT id FROM versions v
+    WHERE last_seen = (SELECT MAX(last_seen) FROM versions WHERE bot_id = v.bot_id)
+)
+SELECT bots.name, COUNT(*), SUM(mp.score), SUM(mp.score * mp.score)
+FROM match_players mp
+JOIN matches m ON m.id = mp.match_id
+JOIN versions v ON v.id = mp.version_id
+JOIN bots ON bots.id = v.bot_id
+WHERE m.p1_version IN latest AND m.p2_version IN latest AND m.engine_version = ?
+GROUP BY bots.id
+'''
+
+def aggregate_rounds(data):
+    '''
+    Sums up the round records of a match for each named player, in p1, p2
+    order.
+    '''
+    aggregates = [
+        {'rounds_won': 0, 'rounds_lost': 0, 'rounds_tied': 0, 'actions': [0, 0, 0], 'latencies': []}
+        for _ in range(2)
+    ]
+    for _, order, *fields in iter_records(data):
+        actions, deltas, latencies = fields[0:2], fields[2:4], fields[4:6]
+        for seat in range(2):
+            aggregate = aggregates[seat ^ order]
+            delta = deltas[seat]
+            aggregate['rounds_won' if delta > 0 else 'rounds_lost' if delta < 0 else 'rounds_tied'] += 1
+            aggregate['actions'][actions[seat]] += 1
+            if not math.isnan(latencies[seat]):
+                aggregate['latencies'].append(latencies[seat])
+    return aggregates
+
+class ResultsDB():
+    '''
+    Writes match results to, and reads the leaderboard from, a SQLite
+    database. Each call opens its own connection, so one instance can be
+    shared by threads and processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self.connect()) as connection:
+            # lets readers run alongside the writers of a tournament
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+    def connect(self):
+        # transactions are begun explicitly, see record_match
+        return sqlite3.connect(self.path, timeout=TIMEOUT, isolation_level=None)
+
+    @staticmethod
+    def version_id(connection, name, bot_hash, now):
+        connection.execute('INSERT OR IGNORE INTO bots (name) VALUES (?)', (name,))
+        (bot_id,) = connection.execute('SELECT id FROM bots WHERE name = ?', (name,)).fetchone()
+        connection.execute('''
+            INSERT INTO versions (bot_id, hash, first_seen, last_seen) VALUES (?, ?, ?, ?)
+            ON CONFLICT (bot_id, hash) DO UPDATE SET last_seen = excluded.last_seen
+        ''', (bot_id, bot_hash, now, now))
+        (version_id,) = connection.execute('SELECT id FROM versions WHERE bot_id = ? AND hash = ?', (bot_id, bot_hash)).fetchone()
+        return version_id
+
+    def record_match(self, *, p1, p2, scores, rounds, seed, n_rounds, switch_seats, engine_version):
+        '''
+        Writes one finished match in a single transaction. p1 and p2 are the
+        (name, hash) of each bot, scores the (name, score) pairs the match
+        returned, in any order, and rounds the contents of its round records
+        file.
+        '''
+        aggregates = aggregate_rounds(rounds)
+        scores_by_name = dict(scores)
+        now = time.time()
+        with closing(self.connect()) as connection:
+            # takes the write lock up front, so waiting writers never deadlock
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                version_ids = [self.version_id(connection, name, bot_hash, now) for name, bot_hash in (p1, p2)]
+                match_id = connection.execute('''
+                    INSERT INTO matches (p1_version, p2_version, seed, n_rounds, switch_seats, engine_version, finished)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (*version_ids, seed, n_rounds, switch_seats, engine_version, now)).lastrowid
+                connection.executemany('''
+                    INSERT INTO match_players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (
+                        match_id,
+                        seat,
+                        version_id,
+                        scores_by_name[name],
+                        aggregate['rounds_won'],
+                        aggregate['rounds_lost'],
+                        aggregate['rounds_tied'],
+                        *aggregate['actions'],
+                        sum(aggregate['latencies']) / len(aggregate['latencies']) if aggregate['latencies'] else None,
+                        max(aggregate['latencies'], default=None),
+                    )
+                    for seat, ((name, _), version_id, aggregate) in enumerate(zip((p1, p2), version_ids, aggregates))
+                ])
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+
+    def leaderboard(self, engine_version):
+        '''
+        Returns the (name, mean, stderr) of the match scores of every bot,
+        over matches between the latest versions of the bots.
+        '''
+        with closing(self.connect()) as connection:
+            rows = connection.execute(LEADERBOARD_QUERY, (engine_version,)).fetchall()
+        leaderboard = []
+        for name, n_matches, total, total_squares in rows:
+            mean = total / n_matches
+            if n_matches > 1:
+                variance = max(total_squares - n_matches * mean * mean, 0.) / (n_matches - 1)
+                stderr = math.sqrt(variance / n_matches)
+            else:
+                stderr = math.inf
+            leaderboard.append((name, mean, stderr))
+        return leaderboard
@@ -0,0 +1,155 @@
+'''
+Aggregates the scores of every match in an output directory into the
+Name,Mean,StdErr CSV that leaderboard.py reads.
+
+By default each scores.*.txt file is one sample per bot, its match score.
+With --rounds every round in the match's rounds file is a sample instead,
+scaled to the same points per 100 rounds. Files are scanned in parallel;
+each worker keeps streaming Welford accumulators and the main process
+merges them with Chan's formula, so no sample is held in memory.
+'''
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+import csv
+import json
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from config import LOGS_PATH, ROUNDS_FILENAME, SCORE_FILENAME
+from records import HEADER, MAGIC, VERSION, column
+
+class Moments:
+    '''
+    Streaming count, mean and sum of squared deviations of a sample.
+    '''
+
+    def __init__(self, n=0, mean=0., m2=0.):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, x):
+        # Welford's update
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        # Chan's parallel combination
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+
+    def stderr(self):
+        if self.n < 2:
+            return math.inf
+        return math.sqrt(self.m2 / (self.n - 1) / self.n)
+
+def read_scores(path):
+    '''
+    Returns the (name, score) pairs of a scores file.
+    '''
+    with open(path) as score_file:
+        return [(name, float(score)) for name, score in (line.rsplit(',', 1) for line in score_file.read().splitlines())]
+
+def find_match_dir(output_path, names):
+    '''
+    Returns the directory of the match between two named bots. It is named
+    p1.p2, and older score files may list the bots in either order.
+    '''
+    for p1_name, p2_name in (names, names[::-1]):
+        match_dir = os.path.join(output_path, f'{p1_name}.{p2_name}')
+        if os.path.isdir(match_dir):
+            return match_dir, [p1_name, p2_name]
+    raise FileNotFoundError(f'no match directory for {names[0]} and {names[1]}')
+
+def round_moments(path, n_players):
+    '''
+    Returns the Moments of the per-round payoffs of each named player in a
+    rounds file, in p1, p2 order and in points per 100 rounds.
+    '''
+    with open(path, 'rb') as rounds_file:
+        data = rounds_file.read()
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a version {VERSION} records file')
+    # there are only a few distinct (order, delta) pairs, so they are counted
+    # and each count merged in as a group of equal samples
+    counts = Counter(zip(column(data, 'order'), column(data, 'delta0')))
+    moments = [Moments() for _ in range(n_players)]
+    for (order, delta0), n in counts.items():
+        delta0 = delta0 - 256 if delta0 > 127 else delta0
+        # seat 1 always gets -delta0; order says which seat the first player held
+        p1_delta = delta0 if order == 0 else -delta0
+        for seat, delta in enumerate((p1_delta, -p1_delta)):
+            moments[seat].merge(Moments(n, delta * 100.))
+    return moments
+
+def aggregate(job):
+    '''
+    Accumulates the scores of a chunk of matches in a worker process.
+    Returns the Moments of each bot.
+    '''
+    output_path, filenames, rounds = job
+    totals = {}
+    for filename in filenames:
+        try:
+            scores = read_scores(os.path.join(output_path, filename))
+            if rounds:
+                # the bots are named in the file, which a renamed file cannot change
+                match_dir, names = find_match_dir(output_path, [name for name, _ in scores])
+                samples = dict(zip(names, round_moments(os.path.join(match_dir, f'{ROUNDS_FILENAME}.bin'), len(names))))
+            else:
+                samples = {name: Moments(1, score) for name, score in scores}
+        except (OSError, ValueError) as e:
+            print(f'WARN Skipping {filename}: {e}')
+            continue
+        for name, moments in samples.items():
+            totals.setdefault(name, Moments()).merge(moments)
+    return totals
+
+def find_score_files(output_path):
+    prefix = f'{SCORE_FILENAME}.'
+    with os.scandir(output_path) as entries:
+        return sorted(entry.name for entry in entries if entry.name.startswith(prefix) and entry.name.endswith('.txt') and entry.is_file())
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate match scores into the CSV leaderboard.py reads.")
+    parser.add_argument("output_path", nargs='?', default=LOGS_PATH, help="Output directory of the matches to aggregate")
+    parser.add_argument("-o", "--output", default="scores.csv", help="Path to the aggregated file (default: scores.csv)")
+    parser.add_argument("--format", default='csv', choices=['csv', 'json'], help="Format of the aggregated file")
+    parser.add_argument("--rounds", default=False, action=argparse.BooleanOptionalAction,
+                        help="Take every round from the rounds files as a sample instead of every match score")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of files to scan in parallel")
+
+    args = parser.parse_args()
+
+    filenames = find_score_files(args.output_path)
+    chunk_size = max(1, math.ceil(len(filenames) / (args.workers * 4)))
+    jobs = [(args.output_path, filenames[i:i + chunk_size], args.rounds) for i in range(0, len(filenames), chunk_size)]
+    totals = {}
+    with Pool(args.workers) as pool:
+        for chunk_totals in pool.imap_unordered(aggregate, jobs):
+            for name, moments in chunk_totals.items():
+                totals.setdefault(name, Moments()).merge(moments)
+
+    rows = sorted(((name, moments.mean, moments.stderr(), moments.n) for name, moments in totals.items()), key=lambda row: -row[1])
+    with open(args.output, 'w', newline='') as f:
+        if args.format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(['Name', 'Mean', 'StdErr', 'N'])
+            writer.writerows(rows)
+        else:
+            json.dump([{"name": name, "mean": mean, "stderr": stderr, "n": n} for name, mean, stderr, n in rows], f, indent=2)
+    print(f"Aggregated {len(filenames)} matches of {len(totals)} bots into {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,10 @@ import json
 import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from config import ENGINE_VERSION
+from results_db import ResultsDB
+
 CLUSTER_MAX_SIGMA = 0.8
 
 @dataclass
@@ -159,15 +163,22 @@ def read_scores(filename):
 
     return sorted(players, key=lambda x: x.mean)
 
+def read_db(path):
+    players = [Player(name, mean, stderr) for name, mean, stderr in ResultsDB(path).leaderboard(ENGINE_VERSION)]
+    return sorted(players, key=lambda x: x.mean)
+
 def main():
     parser = argparse.ArgumentParser(description="Generate a leaderboard JSON from scores.")
-    parser.add_argument("scores_file", help="Path to the input scores file")
+    parser.add_argument("scores_file", nargs='?', help="Path to the input scores file")
+    parser.add_argument("--db", help="Query the latest bot versions in a SQLite results database instead of reading a scores file")
     parser.add_argument("-o", "--output", default="leaderboard.json",
                         help="Path to the output JSON file (default: leaderboard.json)")
 
     args = parser.parse_args()
+    if (args.scores_file is None) == (args.db is None):
+        parser.error("give either a scores file or --db")
 
-    players = read_scores(args.scores_file)
+    players = read_db(args.db) if args.db else read_scores(args.scores_file)
     groups = create_groups(players)
     print_groups(groups)
     
@@ -0,0 +1,288 @@
+'''
+Round-robin tournament runner for the RPS game engine.
+
+Runs every pairing of the discovered bots as an engine Match, spread over a
+process pool. Pairings whose scores are in the results cache are not run
+again.
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from multiprocessing import Pool
+from pathlib import Path
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+sys.path.append(os.getcwd())
+from config import *
+from engine import BackgroundWriter, BuildCache, LogWriter, Match, Multiplexer, TRANSPORTS, build_bot, hash_bot, load_commands
+
+def discover_bots(roots):
+    '''
+    Finds every bot directory (one containing a commands.json) in roots.
+
+    A root may itself be a bot directory or contain bot directories. Returns
+    a list of (name, path) pairs named after the bot directory.
+    '''
+    bots = []
+    seen_paths = set()
+    seen_names = set()
+    for root in roots:
+        root = Path(root)
+        if not root.is_dir():
+            continue
+        if (root / 'commands.json').is_file():
+            candidates = [root]
+        else:
+            candidates = sorted(d for d in root.iterdir() if (d / 'commands.json').is_file())
+        for path in candidates:
+            real_path = path.resolve()
+            if real_path in seen_paths:
+                continue
+            name = path.name
+            if name in seen_names:
+                print(f'WARN Skipping {path}: a bot named {name} already exists')
+                continue
+            seen_paths.add(real_path)
+            seen_names.add(name)
+            bots.append((name, str(path)))
+    return bots
+
+def schedule(bots):
+    '''
+    Builds the round-robin pairing schedule.
+    '''
+    return list(combinations(bots, 2))
+
+def prebuild(bots, cache, *, capture, workers=None):
+    '''
+    Builds every bot once, in parallel, so that no match has to.
+    '''
+    def build(bot):
+        name, path = bot
+        commands = load_commands(name, path)
+        if commands is not None and len(commands['build']) > 0:
+            build_bot(name, path, commands['build'], capture=capture, cache=cache)
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        list(executor.map(build, bots))
+
+class ResultsCache():
+    '''
+    Scores of finished matches, keyed by the hashes of both bot directories
+    and everything else that decides the outcome of a match. A pairing
+    whose key is cached does not need to be played again.
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    @staticmethod
+    def key(p1, p2, *, seed, n_rounds, switch_seats):
+        '''
+        Builds the cache key of a pairing from the (name, hash) of each seat.
+        '''
+        key = json.dumps([*p1, *p2, seed, int(n_rounds), switch_seats, ENGINE_VERSION])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def lookup(self, key):
+        '''
+        Returns the cached scores of a pairing, or None if it must be played.
+        '''
+        try:
+            with open(self.path / f'{key}.json') as cache_file:
+                return [tuple(score) for score in json.load(cache_file)]
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, scores):
+        self.path.mkdir(parents=True, exist_ok=True)
+        # written aside and renamed, as parallel tournaments may share the cache
+        fd, temp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(scores, cache_file)
+        os.replace(temp_path, self.path / f'{key}.json')
+
+def pairing_keys(pairings, *, seed, n_rounds, switch_seats, workers=None):
+    '''
+    Builds the results cache key of every pairing, hashing each bot once.
+    '''
+    bots = {bot for pairing in pairings for bot in pairing}
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        hashes = dict(zip(bots, executor.map(lambda bot: hash_bot(bot[1]), bots)))
+    return [
+        ResultsCache.key(
+            (p1[0], hashes[p1]),
+            (p2[0], hashes[p2]),
+            seed = seed,
+            n_rounds = n_rounds,
+            switch_seats = switch_seats,
+        )
+        for p1, p2 in pairings
+    ]
+
+def run_pairing(job):
+    '''
+    Runs one pairing in a worker process. Returns None if the match
+    failed, so the rest of the tournament still runs.
+    '''
+    (p1, p2), options = job
+    try:
+        return Match(p1=p1, p2=p2, **options).run()
+    except Exception:
+        traceback.print_exc()
+        return None
+
+def run_tournament(bots, *, output_path, n_rounds, workers=None, multiplex=0, results_cache=RESULTS_CACHE_PATH, **options):
+    '''
+    Runs every pairing of bots and writes the combined result file.
+    Returns the list of per-match scores, leaving out pairings that failed.
+
+    With multiplex, up to that many matches run at once on threads of this
+    process, and bots that support it play all of theirs from one process.
+    With a results cache, only pairings missing from it are played.
+    '''
+    pairings = schedule(bots)
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+    build_cache = options.setdefault('build_cache', BUILD_CACHE_PATH)
+    if build_cache is not None:
+        prebuild(bots, BuildCache(build_cache), capture=options.get('capture', True), workers=workers)
+    options.update(output_path=output_path, n_rounds=n_rounds)
+    results = {}
+    if results_cache is not None:
+        # hashed after the builds, as the build cache is
+        cache = ResultsCache(results_cache)
+        keys = pairing_keys(
+            pairings,
+            seed = options.get('seed', SEED),
+            n_rounds = n_rounds,
+            switch_seats = options.get('switch_seats', True),
+            workers = workers,
+        )
+        for i, key in enumerate(keys):
+            scores = cache.lookup(key)
+            if scores is not None:
+                results[i] = pairing_scores(pairings[i], scores)
+                write_scores(output_path, pairings[i], results[i])
+        print(f'{len(results)} of {len(pairings)} pairings are cached')
+    pending = [i for i in range(len(pairings)) if i not in results]
+
+    def record(n_played, i, scores):
+        if scores is None:
+            (p1_name, _), (p2_name, _) = pairings[i]
+            print(f'[{n_played}/{len(pending)}] WARN {p1_name} vs {p2_name} failed and is left out of the results')
+            return
+        report_pairing(n_played, len(pending), scores)
+        results[i] = scores
+        if results_cache is not None:
+            cache.store(keys[i], scores)
+
+    if multiplex:
+        multiplexer = Multiplexer(
+            output_path,
+            capture = options.get('capture', True),
+            transport = options.get('transport', TRANSPORT),
+        )
+        jobs = [(pairings[i], {**options, 'multiplexer': multiplexer}) for i in pending]
+        try:
+            with ThreadPoolExecutor(multiplex) as executor:
+                for n_played, (i, scores) in enumerate(zip(pending, executor.map(run_pairing, jobs)), start=1):
+                    record(n_played, i, scores)
+        finally:
+            if options.get('background'):
+                # matches still being finished may be talking to the shared bots
+                BackgroundWriter.shared().wait()
+            multiplexer.close()
+    else:
+        jobs = [(pairings[i], options) for i in pending]
+        with Pool(workers or os.cpu_count()) as pool:
+            for n_played, (i, scores) in enumerate(zip(pending, pool.imap(run_pairing, jobs)), start=1):
+                record(n_played, i, scores)
+            # let the workers exit cleanly so they shut down their pooled bots
+            pool.close()
+            pool.join()
+    results = [results[i] for i in range(len(pairings)) if i in results]
+    write_results(output_path, results)
+    return results
+
+def report_pairing(i, n_pairings, scores):
+    print(f'[{i}/{n_pairings}] ' + ' vs '.join(f'{name} ({score:+.2f})' for name, score in scores))
+
+def pairing_scores(pairing, scores):
+    '''
+    Puts the (name, score) pairs of a match in the p1, p2 order of its
+    pairing.
+    '''
+    scores_by_name = dict(scores)
+    return [(name, scores_by_name[name]) for name, _ in pairing]
+
+def write_scores(output_path, pairing, scores):
+    '''
+    Writes the score file of one match under the names of its pairing, as
+    the engine does.
+    '''
+    (p1_name, _), (p2_name, _) = pairing
+    scores = pairing_scores(pairing, scores)
+    with open(f'{output_path}/{SCORE_FILENAME}.{p1_name}.{p2_name}.txt', 'w') as score_file:
+        score_file.write('\n'.join([f'{name},{score}' for name, score in scores]))
+
+def write_results(output_path, results):
+    '''
+    Writes the combined result file of a tournament.
+    '''
+    with open(f'{output_path}/{TOURNAMENT_FILENAME}.csv', 'w') as result_file:
+        result_file.write('P1,P2,P1Score,P2Score\n')
+        for (p1_name, p1_score), (p2_name, p2_score) in results:
+            result_file.write(f'{p1_name},{p2_name},{p1_score},{p2_score}\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Round-robin tournament over every discovered bot")
+    parser.add_argument('paths', nargs='*', default=TOURNAMENT_PATHS, metavar='PATH', help='Bot directories, or directories containing bots')
+    parser.add_argument("-o", "--output", default=LOGS_PATH, metavar='PATH', help="Output directory for game results")
+    parser.add_argument("-n", "--n-rounds", default=1000, metavar='INT', help="Number of rounds to run per matchup")
+    parser.add_argument("-j", "--workers", type=int, metavar='INT', help='Number of matches to run in parallel, defaults to the core count')
+    parser.add_argument("--switch-seats", default=False, action=argparse.BooleanOptionalAction, help='Do players switch seats between rounds')
+    parser.add_argument("--capture", default=False, action=argparse.BooleanOptionalAction, help='Capture player outputs and write them to log files')
+    parser.add_argument("--protocol", default=PROTOCOL, choices=['json', 'compact'], help='Wire protocol to offer players at hello')
+    parser.add_argument("--transport", default=TRANSPORT, choices=sorted(TRANSPORTS), help='How players connect to the engine')
+    parser.add_argument("--log-compression", default=LOG_COMPRESSION, choices=sorted(LogWriter.OPENERS), help='Compress game logs and message transcripts as they are written')
+    parser.add_argument("--seed", type=int, default=SEED, metavar='INT', help='Seed of the random actions played for bots that fail to act')
+    parser.add_argument("--build-cache", default=BUILD_CACHE_PATH, metavar='PATH', help='Build every bot once up front and skip builds of unchanged bots')
+    parser.add_argument("--no-build-cache", dest='build_cache', action='store_const', const=None, help='Build both bots before every match')
+    parser.add_argument("--results-cache", default=RESULTS_CACHE_PATH, metavar='PATH', help='Only play pairings whose scores are not cached for the current bots and settings')
+    parser.add_argument("--no-results-cache", dest='results_cache', action='store_const', const=None, help='Play every pairing')
+    parser.add_argument("--db", metavar='PATH', help='Also write every match result to this SQLite results database')
+    parser.add_argument("--zygote", default=False, action=argparse.BooleanOptionalAction, help='Fork python3 player.py bots from a pre-warmed interpreter in each worker')
+    parser.add_argument("--multiplex", type=int, default=0, metavar='INT', help='Run this many matches at once in one process, sharing one process per bot between them')
+    parser.add_argument("--background", default=False, action=argparse.BooleanOptionalAction, help='Stop bots and write logs in the background while the next match starts')
+    parser.add_argument("--reuse-bots", default=False, action=argparse.BooleanOptionalAction, help='Keep bots that support new_match running between matches')
+    parser.add_argument("--in-process", default=False, action=argparse.BooleanOptionalAction, help='Import trusted Python bots into the engine process instead of running them as subprocesses')
+
+    args = parser.parse_args()
+
+    bots = discover_bots(args.paths)
+    print(f'Found {len(bots)} bots: ' + ', '.join(name for name, _ in bots))
+    run_tournament(
+        bots,
+        output_path = args.output,
+        n_rounds = args.n_rounds,
+        workers = args.workers,
+        multiplex = args.multiplex,
+        results_cache = args.results_cache,
+        switch_seats = args.switch_seats,
+        capture = args.capture,
+        in_process = args.in_process,
+        protocol = args.protocol,
+        transport = args.transport,
+        log_compression = args.log_compression,
+        build_cache = args.build_cache,
+        zygote = args.zygote,
+        reuse_bots = args.reuse_bots,
+        background = args.background,
+        seed = args.seed,
+        db = args.db,
+    )
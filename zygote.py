@@ -0,0 +1,286 @@
+'''
+Fork server for fast Python pokerbot startup.
+
+The zygote is an interpreter that imports the modules every Python bot
+needs once, then forks a child per bot instance. The child changes into
+the bot's directory and runs its player.py as __main__, so a launch costs a
+fork instead of an interpreter startup.
+
+The engine hands the zygote a listening Unix socket. For every bot it
+connects and sends one json line {'cwd': PATH, 'argv': LIST}, passing the
+write end of the bot's output pipe alongside with SCM_RIGHTS when output is
+captured. The zygote answers {'pid': INT} and, once the child has exited
+and been reaped, {'returncode': INT} on the same connection.
+
+Each bot keeps its own skeleton, so only the standard library modules the
+skeleton uses are preloaded, never the skeleton itself.
+'''
+import argparse
+import atexit
+import json
+import os
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import shutil
+
+PRELOAD = ['collections', 'dataclasses', 'random', 'struct']
+
+class ZygoteProcess():
+    '''
+    A pokerbot forked by the zygote. Offers the parts of the Popen interface
+    the engine uses.
+    '''
+
+    def __init__(self, connection, stdout):
+        self.connection = connection
+        self.buffer = b''
+        self.pid = None
+        self.stdout = stdout
+        self.returncode = None
+
+    def receive(self, timeout=None):
+        '''
+        Reads the next json line from the zygote. Returns None if the zygote
+        closed the connection.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while b'\n' not in self.buffer:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.)
+            if not select.select([self.connection], [], [], remaining)[0]:
+                raise subprocess.TimeoutExpired(['player.py'], timeout)
+            chunk = self.connection.recv(4096)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return json.loads(line)
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the zygote to report that the bot exited. Returns its exit
+        status.
+        '''
+        if self.returncode is None:
+            reply = self.receive(timeout)
+            # a zygote that died cannot report; its children die with it
+            self.returncode = reply['returncode'] if reply is not None else -signal.SIGKILL
+            self.connection.close()
+        return self.returncode
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                return self.wait(timeout=0.)
+            except subprocess.TimeoutExpired:
+                return None
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+class Zygote():
+    '''
+    Starts a zygote process and forks pokerbots from it.
+    '''
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix='rps-zygote-')
+        self.path = f'{self.directory}/zygote.sock'
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server_socket.bind(self.path)
+        server_socket.listen()
+        # the zygote exits when its stdin closes, so it never outlives us
+        self.process = subprocess.Popen(
+            [sys.executable, __file__, '--fd', str(server_socket.fileno())],
+            stdin=subprocess.PIPE,
+            pass_fds=(server_socket.fileno(),),
+        )
+        server_socket.close()
+
+    @classmethod
+    def shared(cls):
+        '''
+        Returns the zygote of this process, starting it on first use.
+        '''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+                atexit.register(cls._shared.close)
+            return cls._shared
+
+    @staticmethod
+    def can_run(command, transport):
+        '''
+        Whether a bot run command can be forked from the zygote: it must be
+        a plain python3 player.py, and the bot must connect by address
+        rather than through an inherited socket.
+        '''
+        return (len(command) == 2
+                and os.path.basename(command[0]) in ('python', 'python3')
+                and command[1] == 'player.py'
+                and not transport.pass_fds)
+
+    def spawn(self, path, args, *, capture, timeout):
+        '''
+        Forks a pokerbot that runs path/player.py with args, waiting up to
+        timeout for the zygote to answer. Returns its ZygoteProcess.
+        '''
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stdout = None
+        try:
+            connection.connect(self.path)
+            request = json.dumps({'cwd': os.path.abspath(path), 'argv': ['player.py', *args]}).encode() + b'\n'
+            if capture:
+                read_fd, write_fd = os.pipe()
+                stdout = open(read_fd, 'rb')
+                try:
+                    socket.send_fds(connection, [request], [write_fd])
+                finally:
+                    os.close(write_fd)
+            else:
+                connection.sendall(request)
+            process = ZygoteProcess(connection, stdout)
+            reply = process.receive(timeout)
+            if reply is None:
+                raise OSError('zygote closed the connection')
+            process.pid = reply['pid']
+            return process
+        except:
+            if stdout is not None:
+                stdout.close()
+            connection.close()
+            raise
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def run_child(request, fds):
+    '''
+    Runs a pokerbot in a freshly forked child. Never returns.
+    '''
+    code = 1
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        for fd in fds:
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+        os.chdir(request['cwd'])
+        sys.argv = request['argv']
+        sys.path[0] = request['cwd']
+        runpy.run_path('player.py', run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+def serve(server_socket):
+    '''
+    Forks a pokerbot for every request until stdin closes, reporting the
+    exit status of each child once it is reaped.
+    '''
+    children = {}
+    wakeup, wakeup_signal = socket.socketpair()
+    wakeup.setblocking(False)
+    wakeup_signal.setblocking(False)
+    signal.set_wakeup_fd(wakeup_signal.fileno())
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    while True:
+        readable, _, _ = select.select([server_socket, wakeup, sys.stdin], [], [])
+        if sys.stdin in readable and not os.read(sys.stdin.fileno(), 4096):
+            break
+        if wakeup in readable:
+            try:
+                while wakeup.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+            reap(children)
+        if server_socket in readable:
+            connection, _ = server_socket.accept()
+            try:
+                line, fds, _, _ = socket.recv_fds(connection, 65536, 1)
+                request = json.loads(line)
+            except (OSError, ValueError):
+                connection.close()
+                continue
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for sock in (server_socket, wakeup, wakeup_signal, connection, *children.values()):
+                    sock.close()
+                run_child(request, fds)
+            for fd in fds:
+                os.close(fd)
+            children[pid] = connection
+            try:
+                connection.sendall(json.dumps({'pid': pid}).encode() + b'\n')
+            except OSError:
+                pass
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def reap(children):
+    '''
+    Collects every exited child and reports its exit status.
+    '''
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        connection = children.pop(pid, None)
+        if connection is None:
+            continue
+        try:
+            connection.sendall(json.dumps({'returncode': os.waitstatus_to_exitcode(status)}).encode() + b'\n')
+        except OSError:
+            pass
+        connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fork server for Python pokerbots")
+    parser.add_argument('--fd', type=int, required=True, help='Inherited listening Unix socket')
+
+    args = parser.parse_args()
+
+    for module_name in PRELOAD:
+        __import__(module_name)
+    server_socket = socket.socket(fileno=args.fd)
+    serve(server_socket)
+    # also cleaned up here for engines that exit without running atexit
+    shutil.rmtree(os.path.dirname(server_socket.getsockname()), ignore_errors=True)